@@ -1,33 +1,159 @@
+import time
+
+_rerun_started = time.perf_counter()
+
 import streamlit as st
-import numpy as np
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 import os
+import hashlib
+from io import BytesIO
 from dotenv import load_dotenv
 
 from textwrap import dedent
-from langchain_community.chat_models import ChatOpenAI
-from utils import (
-    extract_and_parse_list_of_dicts,
-    generate_image_from_prompts,
-    display_mask_with_image,
-)
+import telemetry
+from utils import display_mask_with_image, open_site_image, oriented_size, rasterize_selection
 from archi_tasks import task1, task2, task3, task4, generate_task_with_brief
-from archi_crew import ArchitectureDesignCrew
+from job_queue import GenerationError, GenerationService
+from image_cache import default_image_cache
+from image_sinks import MemorySink
+from prompt_parser import ConceptParseError
+
+# crewai, langchain, torch and diffusers are only imported on the Submit path, so drawing
+# on the canvas does not pay for them
 
 # load environment variables from the /app/.env file
 load_dotenv()
 
-llm = ChatOpenAI(model_name="gpt-4-0125-preview")
 repo_id = os.getenv("MODEL")
 
 # Set page layout to wide
 st.set_page_config(layout="wide")
 
+
+@st.cache_resource
+def get_generation_service(repo_id):
+    # One worker process per GPU owns the model and loads it while the UI is used; the jobs of
+    # every session are spread over them and batched together
+    return GenerationService(repo_id)
+
+
+generation_service = get_generation_service(repo_id)
+
+
+@st.cache_resource
+def get_llm():
+    # Shared across reruns and sessions; identical prompts are answered from the LLM cache
+    from llm_cache import cached_chat_model
+
+    return cached_chat_model(model_name="gpt-4-0125-preview")
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def load_site_image(upload_hash, _data, max_width):
+    # Only the canvas preview is kept per upload. JPEGs are decoded straight at a reduced scale, so
+    # drawing on a 24 MP photo never decodes it in full. The returned image is shared and never modified.
+    resized_image, scaling_factor = open_site_image(_data, max_width)
+    return resized_image, scaling_factor, oriented_size(Image.open(BytesIO(_data)))
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def load_full_site_image(upload_hash, _data):
+    # The full-resolution photo is only decoded when images are generated from it
+    return open_site_image(_data)[0]
+
+
+def rect_to_selection(rect, scaling_factor, image_size):
+    # The canvas rectangle as its corner pixels in the full photo, or None when it is empty. The
+    # mask is only drawn when generating, so reruns never allocate a full-resolution array.
+    orig_width, orig_height = image_size
+
+    # Adjust for scaleX and scaleY, in integer pixel coordinates
+    left = int(rect["left"] / scaling_factor)
+    top = int(rect["top"] / scaling_factor)
+    width = int(rect["width"] * rect["scaleX"] / scaling_factor)
+    height = int(rect["height"] * rect["scaleY"] / scaling_factor)
+
+    # Ensure coordinates are within image boundaries
+    left = max(0, left)
+    top = max(0, top)
+    right = min(orig_width, left + width)
+    bottom = min(orig_height, top + height)
+    if right <= left or bottom <= top:
+        return None
+    return ((left, top), (right - 1, top), (right - 1, bottom - 1), (left, bottom - 1))
+
+
+def site_image_and_mask(uploaded_file, selection):
+    # The full photo and the mask of the selection, as the pipeline needs them
+    image = load_full_site_image(upload_hash(uploaded_file), uploaded_file.getvalue())
+    return image, rasterize_selection(selection, image.size)
+
+
+def upload_hash(uploaded_file):
+    # Hash the upload once per file and session rather than on every rerun
+    file_id = getattr(uploaded_file, "file_id", uploaded_file.name)
+    cached = st.session_state.get("upload_hash")
+    if cached is None or cached[0] != file_id:
+        cached = (file_id, hashlib.sha1(uploaded_file.getvalue()).hexdigest())
+        st.session_state["upload_hash"] = cached
+    return cached[1]
+
 # Initialize session state variable for the last rectangle
 if "last_rect" not in st.session_state:
     st.session_state["last_rect"] = None
 
+# Generated images of the last Submit, kept in memory for this session only
+if "results" not in st.session_state:
+    st.session_state["results"] = None
+
+
+def layout_concepts(prompt_list, num_images):
+    # A header, the positive prompt and one column per image for every concept
+    concept_columns = {}
+    for info in prompt_list:
+        st.header(info["concept"])
+        st.write(f"{info['positive']}")
+        concept_columns[info["concept"]] = st.columns(num_images)
+    return concept_columns
+
+
+def show_job_status(placeholder, status):
+    # Queue position while waiting for the worker, progress once the job's images are being generated
+    if status["state"] == "queued" and not generation_service.ready:
+        placeholder.caption("Waiting for the image model to load")
+    elif status["state"] == "queued" and status["position"]:
+        placeholder.caption(f"Waiting for the image generator: {status['position']} job(s) ahead")
+    elif status["state"] in ("queued", "running"):
+        placeholder.caption(f"Generating images for this batch of concepts ({status['done']}/{status['total']})")
+    else:
+        placeholder.empty()
+
+
+def show_timing_breakdown(request_span):
+    # Where the request's time went: crew stages, LLM calls and searches, and the worker's batches
+    # and denoising steps. Stages that ran side by side add up to more than the request took.
+    with st.expander(f"Timing breakdown ({request_span.seconds:.1f}s)"):
+        st.dataframe(
+            [
+                {
+                    "Stage": "\u2003" * row["depth"] + row["span"],
+                    "Calls": row["count"],
+                    "Seconds": round(row["seconds"], 2),
+                }
+                for row in telemetry.breakdown(request_span)
+            ],
+            use_container_width=True,
+            hide_index=True,
+        )
+
+
+def show_result(column, result):
+    # Drafts get a checkbox to pick them for refinement at full quality
+    column.image(result.image, use_column_width=True)
+    if result.latents is not None:
+        column.checkbox("Refine", key=f"refine:{result.concept}:{result.index}")
+
 # Streamlit UI
 st.title("Design Concept Generator")
 
@@ -42,28 +168,24 @@ num_concepts = st.sidebar.number_input(
 num_images = st.sidebar.number_input(
     "Number of images per concept", min_value=1, max_value=15, value=5
 )
+draft_mode = st.sidebar.checkbox(
+    "Draft mode",
+    help="Generate fast previews first and refine only the ones you select at full quality.",
+)
 
 MAX_WIDTH = 1000  # Maximum display width for the canvas
 
+# The selected region of the full photo as polygon points, or None
+selection = None
+
 if uploaded_image is not None:
     # Load the image
-    image = Image.open(uploaded_image)
-    image_array = np.array(image)
-
-    # Get original dimensions
-    orig_width, orig_height = image.size
-
-    # If the image is wider than MAX_WIDTH, resize it
-    if orig_width > MAX_WIDTH:
-        scaling_factor = MAX_WIDTH / orig_width
-        new_width = int(orig_width * scaling_factor)
-        new_height = int(orig_height * scaling_factor)
-        resized_image = image.resize((new_width, new_height))
-    else:
-        scaling_factor = 1.0
-        new_width = orig_width
-        new_height = orig_height
-        resized_image = image
+    resized_image, scaling_factor, (orig_width, orig_height) = load_site_image(
+        upload_hash(uploaded_image), uploaded_image.getvalue(), MAX_WIDTH
+    )
+
+    # Get display dimensions
+    new_width, new_height = resized_image.size
 
     # Display the image with interaction
     st.subheader("Select site") 
@@ -139,59 +261,40 @@ if uploaded_image is not None:
     else:
         st.session_state["last_rect"] = None
 
-    # If we have a last rectangle, generate the mask
+    # If we have a last rectangle, keep it as the selection
     if st.session_state["last_rect"] is not None:
-        rect = st.session_state["last_rect"]
-        # Create a blank mask for the original image size
-        mask_array = np.zeros((orig_height, orig_width), dtype=np.uint8)
-
-        # Adjust for scaleX and scaleY
-        left = rect["left"] / scaling_factor
-        top = rect["top"] / scaling_factor
-        width = rect["width"] * rect["scaleX"] / scaling_factor
-        height = rect["height"] * rect["scaleY"] / scaling_factor
-
-        # Convert to integer pixel coordinates
-        left = int(left)
-        top = int(top)
-        width = int(width)
-        height = int(height)
-
-        # Ensure coordinates are within image boundaries
-        left = max(0, left)
-        top = max(0, top)
-        right = min(orig_width, left + width)
-        bottom = min(orig_height, top + height)
-
-        # Fill the mask with white in the selected region
-        mask_array[top:bottom, left:right] = 255
-
-        # Convert mask_array to PIL Image
-        mask = Image.fromarray(mask_array)
+        selection = rect_to_selection(st.session_state["last_rect"], scaling_factor, (orig_width, orig_height))
 
         # Display the image and mask together
         # st.subheader("Selected Mask")
         # st.image(
-        #     display_mask_with_image(image, mask), caption="The site", use_column_width=True
+        #     display_mask_with_image(
+        #         resized_image, rasterize_selection(selection, resized_image.size, scaling_factor)
+        #     ),
+        #     caption="The site",
+        #     use_column_width=True,
         # )
 
 else:
     st.session_state["last_rect"] = None
 
-# Check if both the image and mask are ready
+if not generation_service.ready:
+    # Jobs submitted now wait in the queue until the worker has loaded the model
+    st.sidebar.caption("The image model is still loading; images start once it is ready.")
+
+# Check if both the image and the selection are ready
 if (
     st.sidebar.button("Submit")
     and uploaded_image is not None
     and st.session_state["last_rect"] is not None
+    and selection is not None
 ):
-    with st.spinner("Generating design concepts..."):
-        # Image is already a PIL Image
-        # Mask is already a PIL Image
-
-        print(type(image))
-        print(image.size)
-        print(type(mask))
-        print(mask.size)
+    with st.spinner("Generating design concepts..."), telemetry.span(
+        "request", num_concepts=num_concepts, num_images=num_images, draft=draft_mode
+    ) as request_span:
+        # The full photo is decoded and the mask drawn only now
+        with telemetry.span("site.load"):
+            image, mask = site_image_and_mask(uploaded_image, selection)
 
         tasks = [
             generate_task_with_brief(task1, design_brief),
@@ -199,44 +302,135 @@ if (
             generate_task_with_brief(task3, design_brief),
             task4,
         ]
-        design_crew = ArchitectureDesignCrew(tasks, llm)
-        result = design_crew.run(num_concepts=num_concepts)
-        parsed_list_of_dicts = extract_and_parse_list_of_dicts(result)[0]
-
-        # Make num_images an input field
-        output_path = "generated_images/"
-        # model = "diffusers/stable-diffusion-xl-1.0-inpainting-0.1"
-        # get HF_HOME from environment variable and append to model
-        generate_image_from_prompts(
-            parsed_list_of_dicts, image, mask, num_images, output_path, repo_id
+        from archi_crew import ArchitectureDesignCrew
+        from concept_pipeline import stream_design_concepts
+        from llm_cache import install_llm_cache
+
+        design_crew = ArchitectureDesignCrew(tasks, get_llm())
+
+        # Concepts are laid out as the prompt agent writes them, and each one is sent to the
+        # pipeline straight away, while the agent is still writing the next ones
+        sink = MemorySink()
+        st.session_state["results"] = sink
+        concept_columns = {}
+        stage_outputs = {}
+
+        total_images = num_concepts * num_images
+        progress = st.progress(0.0, text=f"Generating images (0/{total_images})")
+        job_status = st.empty()
+        done = 0
+        # Prompt embedding cache stats of every job of this request
+        embedding_deltas = []
+        try:
+            for event, payload in stream_design_concepts(
+                design_crew,
+                image,
+                mask,
+                num_images,
+                repo_id,
+                num_concepts=num_concepts,
+                quality="draft" if draft_mode else "full",
+                generate=lambda *args, **kwargs: generation_service.iter_images_from_prompts(
+                    *args,
+                    on_status=lambda status: show_job_status(job_status, status),
+                    on_stats=embedding_deltas.append,
+                    **kwargs,
+                ),
+            ):
+                if event == "concept":
+                    sink.begin(sink.prompt_list + [payload])
+                    concept_columns.update(layout_concepts([payload], num_images))
+                elif event == "image":
+                    sink.add(payload)
+                    show_result(concept_columns[payload.concept][payload.index], payload)
+                    done += 1
+                    total_images = max(total_images, done)
+                    progress.progress(
+                        done / total_images,
+                        text=f"Generating images ({done}/{total_images})",
+                    )
+                elif event == "stages":
+                    stage_outputs = payload
+        except ConceptParseError as e:
+            st.error(f"Could not read the generated prompts: {e}")
+            if e.fragment:
+                st.code(e.fragment)
+        except GenerationError as e:
+            st.error(f"Image generation failed: {e}")
+        progress.empty()
+        job_status.empty()
+
+        llm_cache_stats = install_llm_cache().stats()
+        st.sidebar.caption(
+            f"LLM cache: {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses"
         )
+        # The embedding cache lives in the worker; these are its counts while this request's jobs ran
+        embedding_stats = {key: sum(delta[key] for delta in embedding_deltas) for key in ("hits", "misses", "saved_seconds")}
+        st.sidebar.caption(
+            f"Prompt embeddings: {embedding_stats['hits']} hits, {embedding_stats['misses']} misses, "
+            f"{embedding_stats['saved_seconds']:.1f}s of text encoding saved"
+        )
+        # Looked up here before anything is queued, so hits never wait for the worker
+        image_cache = default_image_cache()
+        if image_cache is not None:
+            image_cache_stats = image_cache.stats()
+            st.sidebar.caption(
+                f"Image cache (all sessions): {image_cache_stats['hits']} hits, {image_cache_stats['misses']} misses"
+            )
+        if stage_outputs:
+            with st.expander("Research questions and findings"):
+                st.markdown(stage_outputs["questions"])
+                st.markdown(stage_outputs["research"])
+            with st.expander("Design concepts"):
+                st.markdown(stage_outputs["concepts"])
+    if telemetry.ENABLED:
+        show_timing_breakdown(request_span)
+
+elif st.session_state["results"] is not None and st.session_state["results"].results():
+    # Show the results of the last Submit again after any other interaction
+    sink = st.session_state["results"]
+
+    selected_drafts = [
+        result
+        for result in sink.results()
+        if result.latents is not None
+        and st.session_state.get(f"refine:{result.concept}:{result.index}")
+    ]
+    if (
+        selected_drafts
+        and st.session_state["last_rect"] is not None
+        and selection is not None
+        and st.sidebar.button(f"Refine selected ({len(selected_drafts)})")
+    ):
+        # Refined images replace their drafts in the session's results
+        with st.spinner("Refining selected drafts..."), telemetry.span(
+            "refine", num_images=len(selected_drafts)
+        ) as request_span:
+            image, mask = site_image_and_mask(uploaded_image, selection)
+            job_status = st.empty()
+            try:
+                for refined in generation_service.iter_refined_images(
+                    selected_drafts,
+                    image,
+                    mask,
+                    on_status=lambda status: show_job_status(job_status, status),
+                ):
+                    sink.add(refined)
+                    st.session_state.pop(f"refine:{refined.concept}:{refined.index}", None)
+            except GenerationError as e:
+                st.error(f"Image generation failed: {e}")
+            job_status.empty()
+        if telemetry.ENABLED:
+            show_timing_breakdown(request_span)
+
+    # Images are only encoded to PNG when a download is requested
+    if st.sidebar.button("Prepare download"):
+        st.sidebar.download_button(
+            "Download images", data=sink.zip_bytes(), file_name="design_concepts.zip"
+        )
+    num_columns = max(result.index for result in sink.results()) + 1
+    concept_columns = layout_concepts(sink.prompt_list, num_columns)
+    for result in sink.results():
+        show_result(concept_columns[result.concept][result.index], result)
 
-        for subfolder in os.listdir(output_path):
-            subfolder_path = os.path.join(output_path, subfolder)
-
-            if os.path.isdir(subfolder_path):
-                st.header(subfolder)
-
-                for info in parsed_list_of_dicts:
-                    if info["concept"] == subfolder:
-                        st.write(f"{info['positive']}")
-
-                image_paths = [
-                    os.path.join(subfolder_path, f)
-                    for f in os.listdir(subfolder_path)
-                    if f.endswith((".png", ".jpg", ".jpeg"))
-                ]
-
-                cols = st.columns(len(image_paths))
-
-                for col, img_path in zip(cols, image_paths):
-                    generated_image = Image.open(img_path)
-                    col.image(generated_image, use_column_width=True)
-
-    # Clean up the generated images
-    for subfolder in os.listdir(output_path):
-        subfolder_path = os.path.join(output_path, subfolder)
-        if os.path.isdir(subfolder_path):
-            for f in os.listdir(subfolder_path):
-                os.remove(os.path.join(subfolder_path, f))
-            os.rmdir(subfolder_path)
+st.sidebar.caption(f"Page rendered in {(time.perf_counter() - _rerun_started) * 1000:.0f} ms")
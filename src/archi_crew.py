@@ -1,34 +1,267 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from crewai import Crew, Task
-from textwrap import dedent
-from archi_agents import Architecture_idea_exploration_agent
-from langchain_community.chat_models import ChatOpenAI
-from utils import extract_and_parse_list_of_dicts, generate_image_from_prompts, convert_image, generate_image_mask
+from langchain_core.callbacks import BaseCallbackHandler
+
+import telemetry
+from archi_agents import VERBOSE, Architecture_idea_exploration_agent
+from checkpoints import default_checkpoint_store
+from prompt_parser import parse_concepts, split_concepts
+
+# The four stages of the crew, in the order they run
+STAGES = ["questions", "research", "concepts", "prompts"]
+
+# The prompts of every concept are written by a call of their own, this many at once
+PROMPT_CONCURRENCY = max(1, int(os.getenv("PROMPT_CONCURRENCY", "15")))
+# Seconds before a concept's call is given up on, and how many times it is tried again
+PROMPT_TIMEOUT_SECONDS = float(os.getenv("PROMPT_TIMEOUT_SECONDS", "120"))
+PROMPT_RETRIES = int(os.getenv("PROMPT_RETRIES", "2"))
+
+def _llm_with(llm, **fields):
+  """Return a copy of llm with fields replaced. pydantic's copy() leaves out the fields
+  declared with exclude=True (tags, metadata, ...), so those are passed along explicitly"""
+  excluded = {name: getattr(llm, name) for name in getattr(llm, "__exclude_fields__", None) or {} if hasattr(llm, name)}
+  return llm.copy(update={**excluded, **fields})
+
+def _llm_with_deadline(llm, seconds):
+  """Return a copy of llm whose requests give up after seconds, without retrying on their
+  own. ChatOpenAI builds its openai client when it is created, and copy() keeps that client,
+  so new clients are made for the copy with the same limits"""
+  fields = {name: value for name, value in (("request_timeout", seconds), ("max_retries", 0)) if hasattr(llm, name)}
+  for name in ("client", "async_client"):
+    client = getattr(getattr(llm, name, None), "_client", None)
+    if hasattr(client, "with_options"):
+      fields[name] = client.with_options(timeout=seconds, max_retries=0).chat.completions
+  return _llm_with(llm, **fields) if fields else llm
+
+class LLMTelemetryHandler(BaseCallbackHandler):
+  """Records every LLM call as a span of the stage that made it, and counts its tokens.
+  Streamed calls report no usage, so their tokens are counted as they arrive"""
+
+  def __init__(self):
+    self._started = {}
+    self._streamed = {}
+
+  def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+    self._started[run_id] = time.perf_counter()
+
+  def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+    self._started[run_id] = time.perf_counter()
+
+  def on_llm_new_token(self, token, *, run_id, **kwargs):
+    self._streamed[run_id] = self._streamed.get(run_id, 0) + 1
+
+  def on_llm_end(self, response, *, run_id, **kwargs):
+    started = self._started.pop(run_id, None)
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    tokens = {
+      "prompt": usage.get("prompt_tokens", 0),
+      "completion": usage.get("completion_tokens", self._streamed.pop(run_id, 0)),
+    }
+    for kind, number in tokens.items():
+      if number:
+        telemetry.count("llm_tokens_total", number, kind=kind)
+    if started is not None:
+      telemetry.record("llm.call", time.perf_counter() - started, prompt_tokens=tokens["prompt"], completion_tokens=tokens["completion"])
+
+  def on_llm_error(self, error, *, run_id, **kwargs):
+    self._started.pop(run_id, None)
+    self._streamed.pop(run_id, None)
+    telemetry.count("llm_errors_total", error=type(error).__name__)
 
 class ArchitectureDesignCrew:
 
-  def __init__(self, tasks, llm):
+  def __init__(self, tasks, llm, checkpoint_store=None):
     self.tasks = tasks
     self.llm = llm
+    self.checkpoint_store = checkpoint_store or default_checkpoint_store()
 
-  def run(self, num_questions=5, num_concepts=5):
-    agents = Architecture_idea_exploration_agent(llm=self.llm)
-    tasks = self.tasks
-    brief_understanding_agent = agents.architecture_brief_question_agent(num_questions=num_questions)
-    research_assistant_agent = agents.research_assistant()
-    concept_generation_agent = agents.concept_generation_agent(num_concepts=num_concepts)
-    text_to_image_prompt_agent = agents.text_to_image_prompt_agent()
-    agents = [brief_understanding_agent, research_assistant_agent, concept_generation_agent, text_to_image_prompt_agent]
-    task1 = Task(description=tasks[0], agent=brief_understanding_agent)
-    task2 = Task(description=tasks[1], agent=research_assistant_agent)
-    task3 = Task(description=tasks[2], agent=concept_generation_agent)
-    task4 = Task(description=tasks[3], agent=text_to_image_prompt_agent)
-    tasks = [task1, task2, task3, task4]
-    
+  def _llm_identity(self):
+    # Checkpoints of one model must never be served for another
+    return {
+      "model": getattr(self.llm, "model_name", type(self.llm).__name__),
+      "temperature": getattr(self.llm, "temperature", None),
+    }
+
+  def _execute_stage(self, agent, description, context):
+    if context:
+      # Same framing crewai uses when it passes the previous task's output along
+      description = description + "\nThis is the context you're working with:\n" + context
+    task = Task(description=description, agent=agent)
     crew = Crew(
-      agents=agents,
-      tasks=tasks,
-      verbose=True
+      agents=[agent],
+      tasks=[task],
+      verbose=VERBOSE
     )
+    return crew.kickoff()
+
+  def _agents_for(self, stage, callbacks, llm=None, **fields):
+    handlers = [LLMTelemetryHandler()] if telemetry.ENABLED else []
+    if stage in callbacks:
+      # A streaming copy of the llm so the handlers see every token as it is generated
+      fields.update(streaming=True, callbacks=list(callbacks[stage]) + handlers)
+    elif handlers:
+      fields.update(callbacks=handlers)
+    llm = llm or self.llm
+    if fields:
+      llm = _llm_with(llm, **fields)
+    return Architecture_idea_exploration_agent(llm=llm)
+
+  def _prompt_concept(self, llm, description, concept, index, attempt):
+    with telemetry.span("crew.prompt", concept=index, attempt=attempt):
+      # A retry must not be served the cached answer that just failed
+      fields = {"cache": False} if attempt else {}
+      agent = self._agents_for("prompt", {}, llm=llm, **fields).text_to_image_prompt_agent()
+      return parse_concepts(self._execute_stage(agent, description, concept))[0]
+
+  def _run_concept_prompts(self, description, concepts, on_concept=None):
+    """Write the prompts of every concept with a call of its own, at most PROMPT_CONCURRENCY
+    in flight, counting calls that timed out but have not returned yet. A call that fails,
+    times out or answers with something unparsable is tried again up to PROMPT_RETRIES
+    times; a concept that still has no prompts is left out.
+    Returns (the prompts of all concepts as a JSON list, whether every concept has them)"""
+    ideas = [None] * len(concepts)
+    keys = [None] * len(concepts)
+    waiting = deque()
+    for index, concept in enumerate(concepts):
+      if self.checkpoint_store:
+        keys[index] = self.checkpoint_store.key("prompt", {
+          "llm": self._llm_identity(),
+          "description": description,
+          "concept": concept,
+        })
+        ideas[index] = self.checkpoint_store.get(keys[index])
+      if ideas[index] is None:
+        waiting.append((index, 0))
+      else:
+        telemetry.count("cache_hits_total", cache="crew_checkpoint")
+        if on_concept:
+          on_concept(ideas[index])
+
+    # The request itself gives up at the deadline, so a call that timed out stops using its
+    # thread and the API; the retries are made here
+    llm = _llm_with_deadline(self.llm, PROMPT_TIMEOUT_SECONDS)
+    executor = ThreadPoolExecutor(max_workers=PROMPT_CONCURRENCY, thread_name_prefix="concept-prompt")
+    # future -> (index, attempt, deadline) of every call still waited for
+    running = {}
+    # future -> time it is taken for hung, of the calls that timed out but still hold their
+    # thread, and their slot, until they return
+    abandoned = {}
+    errors = []
+    try:
+      while waiting or running:
+        abandoned = {future: hung_at for future, hung_at in abandoned.items() if not future.done()}
+        while waiting and len(running) + len(abandoned) < PROMPT_CONCURRENCY:
+          index, attempt = waiting.popleft()
+          # Each call runs in the caller's context, so its spans nest under the prompts stage
+          future = executor.submit(
+            telemetry.propagate(self._prompt_concept), llm, description, concepts[index], index, attempt
+          )
+          running[future] = (index, attempt, time.monotonic() + PROMPT_TIMEOUT_SECONDS)
+
+        now = time.monotonic()
+        deadlines = [deadline for _, _, deadline in running.values()]
+        deadlines += [hung_at for hung_at in abandoned.values() if hung_at > now]
+        if not deadlines:
+          # Every slot is held by a call that never returned; the concepts left cannot be written
+          for index, _ in waiting:
+            telemetry.count("prompt_failures_total", error="TimeoutError")
+            errors.append(TimeoutError(f"No prompts for concept {index + 1}: every call slot is held by a hung call"))
+          break
+        # With every slot held by abandoned calls, wait for one of them to return
+        done, _ = wait([*running, *abandoned], timeout=max(0, min(deadlines) - now), return_when=FIRST_COMPLETED)
+        now = time.monotonic()
+        for future, (index, attempt, deadline) in list(running.items()):
+          if future in done:
+            error = future.exception()
+          elif deadline <= now:
+            # Given up on; its late answer is ignored
+            error = TimeoutError(f"No prompts for concept {index + 1} after {PROMPT_TIMEOUT_SECONDS:g}s")
+            # Its request timeout has ended it long before then, unless it hung
+            abandoned[future] = deadline + PROMPT_TIMEOUT_SECONDS
+          else:
+            continue
+          del running[future]
+
+          if error is None:
+            ideas[index] = future.result()
+            if self.checkpoint_store:
+              self.checkpoint_store.set(keys[index], "prompt", ideas[index])
+            if on_concept:
+              on_concept(ideas[index])
+          elif attempt < PROMPT_RETRIES:
+            telemetry.count("prompt_retries_total", error=type(error).__name__)
+            waiting.append((index, attempt + 1))
+          else:
+            telemetry.count("prompt_failures_total", error=type(error).__name__)
+            errors.append(error)
+    finally:
+      # Do not wait for calls that timed out, they end at their own request timeout
+      executor.shutdown(wait=False, cancel_futures=True)
 
-    result = crew.kickoff()
-    return result
\ No newline at end of file
+    written = [idea for idea in ideas if idea is not None]
+    if not written:
+      raise errors[0]
+    return json.dumps(written, indent=2), len(written) == len(concepts)
+
+  def run_stages(self, num_questions=5, num_concepts=5, callbacks=None, on_concept=None):
+    """Run the crew stage by stage and return the output of every stage as a dict
+    keyed by STAGES. A stage whose inputs (task, agent parameters, model and the
+    previous stage) are unchanged since an earlier run is served from its checkpoint.
+    The prompts of the concepts are written concurrently, one call per concept, and
+    on_concept is called with each concept's dict as soon as it has been written;
+    only when the concepts cannot be told apart is a single call made for all of them.
+    callbacks optionally maps a stage to LangChain callback handlers that receive
+    that stage's tokens as they stream in."""
+    callbacks = callbacks or {}
+    stage_agents = {
+      "questions": lambda agents: agents.architecture_brief_question_agent(num_questions=num_questions),
+      "research": lambda agents: agents.research_assistant(),
+      "concepts": lambda agents: agents.concept_generation_agent(num_concepts=num_concepts),
+      "prompts": lambda agents: agents.text_to_image_prompt_agent(),
+    }
+    stage_params = {
+      "questions": {"num_questions": num_questions},
+      "concepts": {"num_concepts": num_concepts},
+    }
+
+    outputs = {}
+    previous_key = None
+    for stage, description in zip(STAGES, self.tasks):
+      inputs = {
+        "llm": self._llm_identity(),
+        "description": description,
+        "params": stage_params.get(stage, {}),
+        "previous": previous_key,
+      }
+      key = self.checkpoint_store.key(stage, inputs) if self.checkpoint_store else None
+      with telemetry.span(f"crew.{stage}") as stage_span:
+        output = self.checkpoint_store.get(key) if self.checkpoint_store else None
+
+        if output is None:
+          context = outputs[STAGES[STAGES.index(stage) - 1]] if outputs else None
+          concepts = split_concepts(context, expected=num_concepts) if stage == "prompts" and context else []
+          if concepts:
+            stage_span.set(concepts=len(concepts))
+            output, complete = self._run_concept_prompts(description, concepts, on_concept)
+          else:
+            agent = stage_agents[stage](self._agents_for(stage, callbacks))
+            output = self._execute_stage(agent, description, context)
+            complete = True
+          # A stage missing some concepts is run again next time, reusing the concepts written
+          if self.checkpoint_store and complete:
+            self.checkpoint_store.set(key, stage, output)
+        else:
+          stage_span.set(checkpoint=True)
+          telemetry.count("cache_hits_total", cache="crew_checkpoint")
+
+      outputs[stage] = output
+      previous_key = key
+    return outputs
+
+  def run(self, num_questions=5, num_concepts=5):
+    return self.run_stages(num_questions=num_questions, num_concepts=num_concepts)["prompts"]
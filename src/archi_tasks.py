@@ -15,7 +15,7 @@ The brief:
 
 task2 = dedent(f"""
 Given the questions, research the answers to the questions and summarize the findings.
-You must always use the tool to search the internet to find the answers to the questions.
+You must always use the tool to search the internet to find the answers to the questions. Search for all the questions at once, one question per line.
 
 After you have obtained the findings, output the summary incorporating all the research findings. Your final answer is the summary.         
 """)
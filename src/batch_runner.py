@@ -0,0 +1,250 @@
+"""
+Run many design briefs end to end without the UI.
+
+Every line of the jobs file is a JSON object:
+    {"id": "site-001", "brief": "...", "image": "sites/site-001.jpg", "mask": [0.3, 0.23, 0.87, 0.65],
+     "num_concepts": 5, "num_images": 5, "seed": 0}
+
+image is a path (relative to the jobs file) or URL. mask holds the top-left and bottom-right ratios
+passed to utils.generate_image_mask. id, num_concepts (default 5), num_images (default 5) and seed
+(default 0) are optional; without an id the job is identified by a hash of its contents.
+
+While the images of one job are generated, the crew (LLM and search) stages of the next jobs already
+run in the background. Results are written to:
+    <results>/manifest.jsonl             one line per finished or failed job
+    <results>/<id>/stages.json           output of every crew stage
+    <results>/<id>/prompts.json          the parsed [{"concept", "positive", "negative"}] list
+    <results>/<id>/images/<concept>/     prompts.txt and generated_image_<i>.png
+
+Jobs already recorded as done in the manifest are skipped, so an interrupted run is resumed by running
+the same command again. Crew stages of a job that was interrupted are served from their checkpoints,
+and the images it had already generated from the image cache.
+
+Usage, from the src directory:
+    python batch_runner.py jobs.jsonl results/ [--prefetch 1] [--shard]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import telemetry
+from common import atomic_write
+from archi_tasks import task1, task2, task3, task4, generate_task_with_brief
+from prompt_parser import parse_concepts
+from utils import convert_image, generate_image_from_prompts, generate_image_mask
+
+JOB_DEFAULTS = {"num_concepts": 5, "num_images": 5, "seed": 0}
+
+
+def _is_number(value, types):
+    # JSON true and false load as bools, which are ints too
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def read_jobs(path):
+    """
+    Read and validate the jobs file.
+
+    Returns:
+    - A list of job dicts with every default filled in, an id and the image path resolved.
+
+    Raises:
+    - ValueError naming the line of the first invalid job.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    seen = set()
+    with open(path) as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("a job must be a JSON object")
+                job = {**JOB_DEFAULTS, **job}
+                missing = [field for field in ("brief", "image", "mask") if field not in job]
+                if missing:
+                    raise ValueError(f"missing {', '.join(missing)}")
+                wrong = [field for field in ("id", "brief", "image") if field in job and not isinstance(job[field], str)]
+                wrong += [field for field in JOB_DEFAULTS if not _is_number(job[field], int)]
+                if wrong:
+                    raise ValueError(f"wrong type of {', '.join(wrong)}")
+                if not isinstance(job["mask"], list) or len(job["mask"]) != 4 or not all(_is_number(ratio, (int, float)) for ratio in job["mask"]):
+                    raise ValueError("mask must hold four ratios")
+            except ValueError as e:
+                raise ValueError(f"{path}, line {line_number}: {e}") from e
+
+            job.setdefault("id", hashlib.sha1(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()[:12])
+            if job["id"] in seen:
+                raise ValueError(f"{path}, line {line_number}: duplicate job id {job['id']}")
+            seen.add(job["id"])
+            if "://" not in job["image"]:
+                job["image"] = os.path.join(base_dir, job["image"])
+            jobs.append(job)
+    return jobs
+
+
+class Manifest:
+    """
+    Append-only JSON lines record of finished jobs. The last record of a job wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    self.records[record["id"]] = record
+
+    def is_done(self, job_id):
+        return self.records.get(job_id, {}).get("status") == "done"
+
+    def append(self, record):
+        with open(self.path, "a") as file:
+            file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self.records[record["id"]] = record
+
+
+def _write_json(path, data):
+    with atomic_write(path) as file:
+        json.dump(data, file, indent=2)
+
+
+def run_crew(job, llm):
+    """
+    Run the crew stages of a job and parse its prompts.
+
+    Returns:
+    - (stage outputs, prompt list, seconds taken).
+    """
+    from archi_crew import ArchitectureDesignCrew
+
+    started = time.perf_counter()
+    tasks = [
+        generate_task_with_brief(task1, job["brief"]),
+        task2,
+        generate_task_with_brief(task3, job["brief"]),
+        task4,
+    ]
+    with telemetry.span("job.crew", job=job["id"]):
+        outputs = ArchitectureDesignCrew(tasks, llm).run_stages(num_concepts=job["num_concepts"])
+        with telemetry.span("prompts.parse"):
+            prompt_list = parse_concepts(outputs["prompts"])
+    return outputs, prompt_list, time.perf_counter() - started
+
+
+def run_diffusion(job, prompt_list, job_dir, model, executor=None):
+    """
+    Generate the images of a job into job_dir/images.
+
+    Returns:
+    - (list of image paths relative to job_dir, seconds taken).
+    """
+    started = time.perf_counter()
+    with telemetry.span("job.diffusion", job=job["id"], images=len(prompt_list) * job["num_images"]):
+        image = convert_image(job["image"])
+        mask = generate_image_mask(image, *job["mask"])
+        images_dir = os.path.join(job_dir, "images")
+        generate_image_from_prompts(
+            prompt_list, image, mask, job["num_images"], images_dir, model, seed=job["seed"], executor=executor
+        )
+    paths = [
+        os.path.join("images", idea["concept"], f"generated_image_{i}.png")
+        for idea in prompt_list
+        for i in range(job["num_images"])
+    ]
+    return paths, time.perf_counter() - started
+
+
+def run_jobs(jobs, results_dir, model, llm, prefetch=1, executor=None):
+    """
+    Run the jobs, overlapping the crew stages of the next prefetch jobs with the diffusion of the
+    current one, and record each one in the manifest as it finishes.
+
+    Returns:
+    - The Manifest.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(results_dir, "manifest.jsonl"))
+    pending = [job for job in jobs if not manifest.is_done(job["id"])]
+    print(f"{len(jobs) - len(pending)} of {len(jobs)} jobs already done")
+
+    # The crew only waits on the network, so it runs in threads while the device works on images
+    with ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix="crew") as crews:
+        ahead = deque()
+        for position, job in enumerate(pending):
+            while len(ahead) <= prefetch and position + len(ahead) < len(pending):
+                next_job = pending[position + len(ahead)]
+                ahead.append(crews.submit(run_crew, next_job, llm))
+            crew_future = ahead.popleft()
+
+            job_dir = os.path.join(results_dir, job["id"])
+            os.makedirs(job_dir, exist_ok=True)
+            record = {"id": job["id"], "brief": job["brief"], "image": job["image"]}
+            try:
+                stage_outputs, prompt_list, crew_seconds = crew_future.result()
+                _write_json(os.path.join(job_dir, "stages.json"), stage_outputs)
+                _write_json(os.path.join(job_dir, "prompts.json"), prompt_list)
+                images, diffusion_seconds = run_diffusion(job, prompt_list, job_dir, model, executor)
+                record.update(
+                    status="done",
+                    concepts=[idea["concept"] for idea in prompt_list],
+                    images=images,
+                    seconds={"crew": round(crew_seconds, 2), "diffusion": round(diffusion_seconds, 2)},
+                )
+            except Exception as e:
+                # Failed jobs are recorded but not marked done, so the next run retries them
+                record.update(status="failed", error=f"{type(e).__name__}: {e}")
+            manifest.append(record)
+            print(f"[{position + 1}/{len(pending)}] {job['id']}: {record['status']}")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("jobs", help="JSON lines file with one job per line")
+    parser.add_argument("results", help="Directory for the manifest and the generated images")
+    parser.add_argument("--model", help="Inpainting model. Defaults to the MODEL environment variable")
+    parser.add_argument("--llm", default="gpt-4-0125-preview", help="Chat model used by the crew")
+    parser.add_argument("--prefetch", type=int, default=1, help="Number of jobs whose crew stages run ahead of the images")
+    parser.add_argument("--shard", action="store_true", help="Spread the images over every GPU (or SHARD_CPU_WORKERS processes)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    from llm_cache import cached_chat_model
+
+    model = args.model or os.getenv("MODEL")
+    jobs = read_jobs(args.jobs)
+    executor = None
+    if args.shard:
+        from sharded_executor import ShardedExecutor
+
+        executor = ShardedExecutor(model)
+    try:
+        manifest = run_jobs(jobs, args.results, model, cached_chat_model(model_name=args.llm), args.prefetch, executor)
+    finally:
+        if executor is not None:
+            executor.close()
+
+    failed = [job["id"] for job in jobs if not manifest.is_done(job["id"])]
+    if failed:
+        print(f"{len(failed)} jobs failed: {', '.join(failed)}. Run the same command again to retry them.")
+
+
+if __name__ == "__main__":
+    main()
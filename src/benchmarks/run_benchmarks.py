@@ -0,0 +1,352 @@
+"""
+Benchmark every stage of the app offline, without OpenAI, Tavily or a GPU.
+
+The crew runs its real agents, tools and parsing against FakeChatModel and FakeSearchBackend, and
+images are generated on the CPU by a tiny randomly initialised SDXL inpainting pipeline, so the
+numbers measure this repository's own overhead rather than the services'. Each case is run several
+times; the fastest and the median run are reported. The image cache and crew checkpoints are
+disabled, and every repeat uses new prompts and a new site, so no repeat is served from a cache.
+
+Results are written as JSON together with the commit they were measured on. Pass an earlier result
+file to --compare to report every case that got slower by more than --threshold; the exit status is
+1 when there is such a regression.
+
+Usage, from the src directory:
+    python -m benchmarks.run_benchmarks [--quick] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Set before the app modules read them at import time
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="benchmarks_")
+os.environ["IMAGE_CACHE_DIR"] = ""
+os.environ["CREW_CHECKPOINT_DIR"] = ""
+os.environ["SEARCH_CACHE_PATH"] = os.path.join(_SCRATCH_DIR, "search_cache.sqlite")
+os.environ.setdefault("EXECUTION_PROFILE", "cpu")
+os.environ.setdefault("INPAINT_MODEL_RESOLUTION", "64")
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
+
+from benchmarks.stand_ins import FakeChatModel, FakeSearchBackend, build_tiny_pipeline  # noqa: E402
+
+# (concepts, images per concept) x site size x batch size
+FULL_GRID = {
+    "workloads": [(1, 1), (2, 2), (5, 2)],
+    "site_sizes": [(512, 384), (2048, 1536)],
+    "batch_sizes": [1, 4],
+    "qualities": ["full", "draft"],
+    "crew_concepts": [5, 15],
+    "parse_concepts": [5, 50],
+    "search_queries": [5, 20],
+    "repeat": 3,
+}
+QUICK_GRID = {
+    "workloads": [(2, 2)],
+    "site_sizes": [(512, 384)],
+    "batch_sizes": [4],
+    "qualities": ["full"],
+    "crew_concepts": [5],
+    "parse_concepts": [5],
+    "search_queries": [5],
+    "repeat": 1,
+}
+BRIEF = "A community center in Singapore with a library, a sports hall and a rooftop garden."
+
+
+def measure(function, repeat, items=1):
+    """
+    Run function(run) repeat times and summarise its wall-clock time.
+
+    Returns:
+    - {"min", "median"} seconds per call, or per item when items is more than 1, and the run count.
+    """
+    timings = []
+    for run in range(repeat):
+        started = time.perf_counter()
+        function(run)
+        timings.append((time.perf_counter() - started) / items)
+    return {"min": min(timings), "median": statistics.median(timings), "runs": repeat, "items": items}
+
+
+def _site(size, run):
+    # A noisy photo per run, so no run reuses an earlier one's VAE encoding
+    import numpy as np
+    from PIL import Image
+
+    from utils import generate_image_mask
+
+    pixels = np.random.default_rng(run).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    return image, generate_image_mask(image, 0.3, 0.23, 0.87, 0.65)
+
+
+def _prompt_list(num_concepts, tag):
+    # A new tag gives new prompts, so the text encoders run as they would for a new brief
+    return [
+        {"concept": f"Concept {i}", "positive": f"A pavilion {tag} number {i}, daylight", "negative": "blurry, distorted"}
+        for i in range(1, num_concepts + 1)
+    ]
+
+
+def bench_crew(repeat, concept_counts, llm_latency, llm_token_latency, search_latency):
+    from archi_crew import STAGES, ArchitectureDesignCrew
+    from archi_tasks import generate_task_with_brief, task1, task2, task3, task4
+    from tools.search_cache import set_search_backend
+
+    class TimedCrew(ArchitectureDesignCrew):
+        # A stage is timed from its first call starting to its last one ending, as the prompts of
+        # the concepts are written by concurrent calls
+        def _execute_stage(self, agent, description, context):
+            started = time.perf_counter()
+            output = super()._execute_stage(agent, description, context)
+            stage = STAGES[self.tasks.index(description)]
+            with self.lock:
+                first, last = self.spans.get(stage, (started, 0.0))
+                self.spans[stage] = (min(first, started), max(last, time.perf_counter()))
+            return output
+
+    def run_once(run, num_concepts, stage_timings):
+        # A new brief per run, so neither the crew nor the search cache can reuse an earlier run
+        brief = f"{BRIEF} Run {run} at {time.time()}."
+        tasks = [generate_task_with_brief(task1, brief), task2, generate_task_with_brief(task3, brief), task4]
+        crew = TimedCrew(tasks, FakeChatModel(latency_seconds=llm_latency, token_latency_seconds=llm_token_latency))
+        crew.spans = {}
+        crew.lock = threading.Lock()
+        # crewai prints every agent step
+        with contextlib.redirect_stdout(io.StringIO()):
+            crew.run_stages(num_concepts=num_concepts)
+        for stage, (first, last) in crew.spans.items():
+            stage_timings[stage].append(last - first)
+
+    set_search_backend(FakeSearchBackend(latency_seconds=search_latency))
+    results = {}
+    for num_concepts in concept_counts:
+        stage_timings = {stage: [] for stage in STAGES}
+        results[f"crew.total[concepts={num_concepts}]"] = measure(
+            lambda run: run_once(run, num_concepts, stage_timings), repeat
+        )
+        for stage, timings in stage_timings.items():
+            results[f"crew.{stage}[concepts={num_concepts}]"] = {
+                "min": min(timings), "median": statistics.median(timings), "runs": repeat, "items": 1
+            }
+    return results
+
+
+def bench_search(repeat, query_counts, search_latency):
+    from tools.search_cache import search_many, set_search_backend
+
+    set_search_backend(FakeSearchBackend(latency_seconds=search_latency))
+    results = {}
+    for count in query_counts:
+        tag = f"{count}-{time.time()}"
+        queries = [f"What is fact {i} of run {tag}?" for i in range(count)]
+        results[f"search.cold[queries={count}]"] = measure(
+            lambda run: search_many([f"{query} {run}" for query in queries]), repeat
+        )
+        search_many(queries)
+        results[f"search.cached[queries={count}]"] = measure(lambda run: search_many(queries), repeat)
+    return results
+
+
+def bench_parse(repeat, concept_counts):
+    from utils import extract_and_parse_list_of_dicts
+
+    results = {}
+    for count in concept_counts:
+        text = "Thought: Do I need to use a tool? No\nFinal Answer: " + json.dumps(_prompt_list(count, "parse"), indent=1)
+        # A single parse takes well under a millisecond, so each run times a hundred of them
+        results[f"parse[concepts={count}]"] = measure(
+            lambda run: [extract_and_parse_list_of_dicts(text) for _ in range(100)], repeat, items=100
+        )
+    return results
+
+
+def bench_pipeline_load(repeat, model):
+    from pipeline_registry import get_pipeline, registry
+
+    def load(run):
+        registry.evict()
+        get_pipeline(model)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {"pipeline.load": measure(load, repeat)}
+
+
+def bench_diffusion(repeat, model, grid):
+    from image_sinks import MemorySink
+    from pipeline_registry import get_pipeline
+    from utils import iter_images_from_prompts
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        get_pipeline(model).set_progress_bar_config(disable=True)
+
+    results = {}
+    for quality in grid["qualities"]:
+        for num_concepts, num_images in grid["workloads"]:
+            for site_size in grid["site_sizes"]:
+                for batch_size in grid["batch_sizes"]:
+                    case = f"concepts={num_concepts},images={num_images},site={site_size[0]}x{site_size[1]},batch={batch_size}"
+                    generated = []
+
+                    def generate(run):
+                        image, mask = _site(site_size, run)
+                        prompt_list = _prompt_list(num_concepts, f"{case} {run}")
+                        generated[:] = list(iter_images_from_prompts(
+                            prompt_list, image, mask, num_images, model, batch_size, seed=run, quality=quality
+                        ))
+
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        results[f"diffusion.{quality}[{case}]"] = measure(generate, repeat, items=num_concepts * num_images)
+
+                # Encoding and result assembly do not depend on the batch size
+                site_case = f"concepts={num_concepts},images={num_images},site={site_size[0]}x{site_size[1]}"
+                prompt_list = _prompt_list(num_concepts, "assembly")
+
+                def assemble(run):
+                    # What the app does per Submit: lay out each concept as it arrives, then add its images
+                    sink = MemorySink()
+                    for idea in prompt_list:
+                        sink.begin(sink.prompt_list + [idea])
+                    for result in generated:
+                        sink.add(result)
+                    for idea in sink.prompt_list:
+                        sink.results(idea["concept"])
+                    return sink
+
+                sink = assemble(0)
+
+                def encode_png(run):
+                    sink._encoded.clear()
+                    for result in generated:
+                        sink.png_bytes(result.concept, result.index)
+
+                def encode_zip(run):
+                    sink._encoded.clear()
+                    sink.zip_bytes()
+
+                results[f"ui.assemble.{quality}[{site_case}]"] = measure(assemble, repeat)
+                results[f"encode.png.{quality}[{site_case}]"] = measure(encode_png, repeat, items=len(generated))
+                results[f"encode.zip.{quality}[{site_case}]"] = measure(encode_zip, repeat)
+    return results
+
+
+def environment():
+    """
+    Return what the results depend on besides the code: the commit, the interpreter, torch and the machine.
+    """
+    import torch
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "model_resolution": int(os.environ["INPAINT_MODEL_RESOLUTION"]),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the fastest run of every case found in both result files.
+
+    Returns:
+    - The names of the cases more than threshold (a fraction) slower than in baseline.
+    """
+    regressions = []
+    print(f"{'case':<80} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, result in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        before, now = baseline["cases"][name]["min"], result["min"]
+        change = now / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print(f"{name:<80} {before * 1000:8.2f}ms {now * 1000:8.2f}ms {change:+7.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="One run of a single configuration per stage, as a smoke test")
+    parser.add_argument("--repeat", type=int, help="Runs per case. Defaults to 3, or 1 with --quick")
+    parser.add_argument("--output", default="benchmark_results.json", help="File to write the results to")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown, as a fraction, reported as a regression")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the fake chat model waits per call")
+    parser.add_argument(
+        "--llm-token-latency", type=float, default=0.0, help="Seconds the fake chat model waits per word of its answer"
+    )
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Seconds the fake search backend waits per query")
+    parser.add_argument(
+        "--model-dir",
+        default=os.path.join(tempfile.gettempdir(), "benchmark_tiny_inpaint_pipeline"),
+        help="Where the tiny pipeline is saved; it is built on first use",
+    )
+    parser.add_argument("--skip", nargs="*", default=[], choices=["crew", "search", "parse", "pipeline", "diffusion"], help="Stages to leave out")
+    args = parser.parse_args()
+
+    from diffusers.utils import logging as diffusers_logging
+
+    diffusers_logging.disable_progress_bar()
+    grid = dict(QUICK_GRID if args.quick else FULL_GRID)
+    repeat = args.repeat or grid["repeat"]
+
+    model = build_tiny_pipeline(args.model_dir) if {"pipeline", "diffusion"} - set(args.skip) else None
+    stages = {
+        "crew": lambda: bench_crew(repeat, grid["crew_concepts"], args.llm_latency, args.llm_token_latency, args.search_latency),
+        "search": lambda: bench_search(repeat, grid["search_queries"], args.search_latency),
+        "parse": lambda: bench_parse(max(repeat, 5), grid["parse_concepts"]),
+        "pipeline": lambda: bench_pipeline_load(repeat, model),
+        "diffusion": lambda: bench_diffusion(repeat, model, grid),
+    }
+
+    cases = {}
+    for stage, run in stages.items():
+        if stage in args.skip:
+            continue
+        started = time.perf_counter()
+        stage_results = run()
+        cases.update(stage_results)
+        print(f"{stage}: {len(stage_results)} cases in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    results = {"environment": environment(), "quick": args.quick, "repeat": repeat, "cases": cases}
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Wrote {len(cases)} cases to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline["environment"].get("platform") != results["environment"]["platform"]:
+            print("The baseline was measured on a different machine; differences may not be regressions", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} cases are more than {args.threshold:.0%} slower", file=sys.stderr)
+            sys.exit(1)
+    else:
+        for name, result in cases.items():
+            unit = "per item" if result["items"] > 1 else ""
+            print(f"{name:<80} {result['min'] * 1000:10.2f} ms {unit}")
+
+
+if __name__ == "__main__":
+    main()
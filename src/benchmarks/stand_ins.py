@@ -0,0 +1,194 @@
+"""
+Deterministic offline stand-ins for the parts of the app that need outside services or big models:
+a chat model for the crew, a search backend and a tiny randomly initialised SDXL inpainting pipeline.
+"""
+import json
+import os
+import re
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers every crew stage with a fixed, well-formed response after latency_seconds,
+    plus token_latency_seconds for every word of the response, like a model generating it.
+
+    The stage is recognised from the prompt, so the crew runs its real agents, tools and parsing.
+    Responses are built from the numbers and names found in the prompt and contain no randomness.
+    """
+
+    model_name: str = "fake-chat-model"
+    temperature: float = 0.0
+    latency_seconds: float = 0.0
+    token_latency_seconds: float = 0.0
+    streaming: bool = False
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def respond(self, prompt):
+        """
+        Return the completion for a prompt.
+        """
+        if "Return a valid schema for the tool" in prompt:
+            # crewai asks the llm to turn the agent's Action into a tool call
+            action = prompt.split("Return a valid schema for the tool")[-1]
+            name = re.search(r"Tool Name:\s*(.+)", action).group(1).strip()
+            arguments = re.search(r"Tool Arguments:\s*(.*?)\s*(?:The schema should|$)", action, re.S).group(1)
+            return json.dumps({"tool_name": name, "arguments": {"questions" if "several" in name else "query": arguments}})
+
+        if "generate a positive prompt and a negative prompt" in prompt:
+            names = re.findall(r"^\d+\. (Concept [^:\n]+):", prompt, re.M) or ["Concept 1"]
+            prompts = [
+                {"concept": name, "positive": f"A building in the style of {name}, daylight, photorealistic", "negative": "blurry, distorted"}
+                for name in dict.fromkeys(names)
+            ]
+            return "Thought: Do I need to use a tool? No\nFinal Answer: " + json.dumps(prompts, indent=1)
+
+        if "vastly different architecture design concepts" in prompt:
+            count = int(re.search(r"generate (\d+) vastly different", prompt).group(1))
+            concepts = "\n".join(f"{i}. Concept {i}: A pavilion with a folded timber roof and a courtyard." for i in range(1, count + 1))
+            return "Thought: Do I need to use a tool? No\nFinal Answer: " + concepts
+
+        if "research the answers to the questions" in prompt:
+            # Search first, answer once the tool's results are in the prompt
+            if "Result 1 for" not in prompt:
+                questions = re.findall(r"^\d+\. (.+\?)$", prompt, re.M) or ["What is the climate of the site?"]
+                return (
+                    "Thought: Do I need to use a tool? Yes\n"
+                    "Action: Search the internet for several questions\n"
+                    "Action Input: " + "\n".join(dict.fromkeys(questions))
+                )
+            return "Thought: Do I need to use a tool? No\nFinal Answer: The site is warm and humid, with a young population."
+
+        if "generate questions to research" in prompt:
+            match = re.search(r"maximum of (\d+) questions", prompt)
+            count = int(match.group(1)) if match else 5
+            questions = "\n".join(f"{i}. What is fact number {i} about the site?" for i in range(1, count + 1))
+            return "Thought: Do I need to use a tool? No\nFinal Answer: " + questions
+
+        return "Thought: Do I need to use a tool? No\nFinal Answer: Done."
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self.respond("\n".join(str(message.content) for message in messages))
+        for token in stop or []:
+            text = text.split(token)[0]
+        tokens = re.findall(r"\S+\s*", text)
+        if self.latency_seconds or self.token_latency_seconds:
+            time.sleep(self.latency_seconds + self.token_latency_seconds * len(tokens))
+        if run_manager is not None and self.streaming:
+            for token in tokens:
+                run_manager.on_llm_new_token(token)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class FakeSearchBackend:
+    """
+    Search backend returning max_results fixed snippets per query after latency_seconds.
+    """
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+
+    def search(self, query, max_results):
+        self.calls += 1
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [f"Result {i + 1} for '{query}': a short factual snippet." for i in range(max_results)]
+
+
+def _write_tokenizer(directory):
+    # A byte-level vocabulary without merges: every character is a token, so any prompt encodes
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    symbols = list(bytes_to_unicode().values())
+    vocab = {symbol: i for i, symbol in enumerate(symbols)}
+    vocab.update({symbol + "</w>": len(symbols) + i for i, symbol in enumerate(symbols)})
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "vocab.json"), "w") as file:
+        json.dump(vocab, file)
+    with open(os.path.join(directory, "merges.txt"), "w") as file:
+        file.write("#version: 0.2\n")
+    return len(vocab)
+
+
+def build_tiny_pipeline(directory, seed=0):
+    """
+    Save a tiny randomly initialised SDXL inpainting pipeline to directory, so it can be loaded
+    like any other model through pipeline_registry. It has the SDXL architecture (two text
+    encoders, 9-channel UNet, added time embeddings) at a native resolution of 64x64 pixels.
+
+    Returns:
+    - directory.
+    """
+    import torch
+    from diffusers import AutoencoderKL, EulerDiscreteScheduler, StableDiffusionXLInpaintPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+
+    if os.path.exists(os.path.join(directory, "model_index.json")):
+        return directory
+
+    torch.manual_seed(seed)
+    tokenizer_dir = os.path.join(directory, "_tokenizer")
+    vocab_size = _write_tokenizer(tokenizer_dir)
+    tokenizer = CLIPTokenizer(os.path.join(tokenizer_dir, "vocab.json"), os.path.join(tokenizer_dir, "merges.txt"), model_max_length=77)
+    text_config = CLIPTextConfig(
+        bos_token_id=vocab_size - 2,
+        eos_token_id=vocab_size - 1,
+        pad_token_id=vocab_size - 1,
+        vocab_size=vocab_size,
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        projection_dim=32,
+        hidden_act="gelu",
+    )
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=9,
+        out_channels=4,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        transformer_layers_per_block=(1, 1),
+        cross_attention_dim=64,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        projection_class_embeddings_input_dim=80,
+    )
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        block_out_channels=[32, 64],
+        down_block_types=["DownEncoderBlock2D"] * 2,
+        up_block_types=["UpDecoderBlock2D"] * 2,
+        latent_channels=4,
+        sample_size=64,
+    )
+    scheduler = EulerDiscreteScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", steps_offset=1, timestep_spacing="leading"
+    )
+    pipe = StableDiffusionXLInpaintPipeline(
+        vae=vae,
+        text_encoder=CLIPTextModel(text_config),
+        text_encoder_2=CLIPTextModelWithProjection(text_config),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        requires_aesthetics_score=False,
+    )
+    pipe.save_pretrained(directory)
+    return directory
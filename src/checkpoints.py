@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import time
+
+from common import atomic_write
+
+
+class StageCheckpointStore:
+    """
+    On-disk store of crew stage outputs, one JSON file per stage keyed by a hash of the stage inputs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(stage, inputs):
+        """
+        Return the checkpoint key of a stage for the given JSON-serializable inputs.
+        """
+        payload = json.dumps({"stage": stage, "inputs": inputs}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return the stored output for key, or None if the stage has not run with these inputs.
+        """
+        try:
+            with open(self._path(key)) as file:
+                return json.load(file)["output"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key, stage, output):
+        with atomic_write(self._path(key)) as file:
+            json.dump({"stage": stage, "output": output, "created_at": time.time()}, file)
+
+
+def default_checkpoint_store():
+    """
+    Return a checkpoint store in CREW_CHECKPOINT_DIR, or None when it is set to an empty value.
+    """
+    directory = os.getenv("CREW_CHECKPOINT_DIR", ".cache/crew_checkpoints")
+    return StageCheckpointStore(directory) if directory else None
@@ -0,0 +1,45 @@
+"""
+Small helpers shared by the app's modules: environment flags, atomic file writes and SQLite
+connections. Only the standard library is imported, so any module can use them.
+"""
+import contextlib
+import os
+import sqlite3
+import tempfile
+
+
+def env_flag(name, default):
+    """
+    Return whether the environment variable name, or default when it is unset, is 1, true, yes or on.
+    """
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Open a temporary file next to path for writing, and move it over path once the block finishes.
+
+    A crash never leaves a truncated file behind, and a reader never sees half a file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def sqlite_connection(path):
+    """
+    Connect to the SQLite database at path for a single operation.
+
+    A connection per operation keeps a store safe to use from several threads. The operation is
+    committed, or rolled back, and the connection closed as soon as the block finishes.
+    """
+    with contextlib.closing(sqlite3.connect(path, timeout=30)) as conn, conn:
+        yield conn
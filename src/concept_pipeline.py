@@ -0,0 +1,116 @@
+import queue
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+import telemetry
+from prompt_parser import ConceptParseError, IncrementalConceptParser, parse_concepts
+from utils import iter_images_from_prompts
+
+_DONE = object()
+
+
+class ConceptStreamHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler that parses the prompt agent's tokens as they stream in and
+    hands each completed concept to on_concept.
+    """
+
+    def __init__(self, on_concept):
+        self.parser = IncrementalConceptParser()
+        self.on_concept = on_concept
+        self.error = None
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self.error is not None:
+            return
+        try:
+            for idea in self.parser.feed(token):
+                self.on_concept(idea)
+        except ConceptParseError as e:
+            # Stop streaming; the final answer is parsed again once the stage finishes
+            self.error = e
+
+
+def stream_design_concepts(design_crew, image, mask, num_images, model, num_concepts=5, max_batch_size=None, seed=0, quality="full", generate=None):
+    """
+    Run the crew and the diffusion stage as a pipeline: the images of a concept are generated as soon
+    as the prompt agent has written its prompts, while the prompts of the other concepts are still
+    being written.
+
+    Parameters:
+    - design_crew: ArchitectureDesignCrew to run.
+    - image: PIL.Image object of the site.
+    - mask: PIL.Image object of the mask.
+    - num_images: Number of images per concept.
+    - model: Hugging Face repo ID of the inpainting model.
+    - num_concepts: Number of concepts the crew should generate.
+    - max_batch_size: Maximum number of images per pipeline call.
+    - seed: Base seed the per-image seeds are derived from.
+    - quality: "full", or "draft" for fast previews that can be refined with utils.iter_refined_images.
+    - generate: Function with the signature of utils.iter_images_from_prompts that renders the images,
+      e.g. GenerationService.iter_images_from_prompts. Defaults to running the pipeline in this process.
+
+    Yields:
+    - ("concept", idea) when a concept has been parsed, before any of its images.
+    - ("image", GeneratedImage) for every generated image.
+    - ("stages", outputs) once at the end, with the output of every crew stage.
+
+    Raises:
+    - ConceptParseError if the prompt agent's final answer cannot be parsed.
+    """
+    generate = generate or iter_images_from_prompts
+    ideas = queue.Queue()
+    stage_outputs = {}
+    handler = ConceptStreamHandler(ideas.put)
+
+    def run_crew():
+        try:
+            with telemetry.span("crew", num_concepts=num_concepts):
+                stage_outputs.update(
+                    design_crew.run_stages(
+                        num_concepts=num_concepts, callbacks={"prompts": [handler]}, on_concept=ideas.put
+                    )
+                )
+            # Checkpointed or cached stages do not stream, so the final answer is always parsed
+            # too; concepts already seen in the stream are skipped below
+            with telemetry.span("prompts.parse"):
+                parsed = parse_concepts(stage_outputs["prompts"])
+            for idea in parsed:
+                ideas.put(idea)
+            ideas.put(_DONE)
+        except Exception as e:
+            ideas.put(e)
+
+    # The crew's spans nest under the caller's, e.g. the request being served
+    threading.Thread(target=telemetry.propagate(run_crew), name="design-crew", daemon=True).start()
+
+    seen = set()
+    finished = False
+    while not finished:
+        # Wait for the next concept, then take everything else that arrived while the GPU was busy
+        entries = [ideas.get()]
+        while True:
+            try:
+                entries.append(ideas.get_nowait())
+            except queue.Empty:
+                break
+
+        new_ideas = []
+        for entry in entries:
+            if isinstance(entry, Exception):
+                raise entry
+            if entry is _DONE:
+                finished = True
+            elif entry["concept"] not in seen:
+                seen.add(entry["concept"])
+                new_ideas.append(entry)
+                yield "concept", entry
+
+        if new_ideas:
+            for result in generate(
+                new_ideas, image, mask, num_images, model, max_batch_size, seed, quality=quality
+            ):
+                yield "image", result
+
+    yield "stages", stage_outputs
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import telemetry
+
+# SDXL encode_prompt outputs, in the order the pipeline's call arguments expect them
+EMBEDDING_KWARGS = ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+
+
+class PromptEmbeddingCache:
+    """
+    Bounded LRU cache of SDXL text encoder outputs keyed by (model, prompt, negative prompt).
+
+    Shared across requests, so concepts that come back (e.g. when a brief is rerun) skip both text
+    encoders. Tracks hits, misses and the encoder time spent, from which the time saved is estimated.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supports(pipe):
+        """
+        Return whether the pipeline has the SDXL two-encoder encode_prompt this cache stores.
+        """
+        return hasattr(pipe, "encode_prompt") and getattr(pipe, "text_encoder_2", None) is not None
+
+    def get(self, pipe, positive, negative):
+        """
+        Return the embeddings of one prompt pair as a dict of the pipeline's embedding arguments,
+        encoding them on a miss.
+        """
+        import torch
+
+        # The same model loaded with another dtype or on another device has embeddings of its own
+        key = (pipe.name_or_path, pipe.dtype, str(pipe._execution_device), positive, negative)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                telemetry.count("cache_hits_total", cache="prompt_embedding")
+                return self._entries[key]
+
+        telemetry.count("cache_misses_total", cache="prompt_embedding")
+        started = time.perf_counter()
+        with telemetry.span("prompt.encode"), torch.no_grad():
+            embeddings = pipe.encode_prompt(
+                prompt=positive,
+                negative_prompt=negative,
+                device=pipe._execution_device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+            )
+        embeddings = dict(zip(EMBEDDING_KWARGS, embeddings))
+
+        with self._lock:
+            self.misses += 1
+            self.encode_seconds += time.perf_counter() - started
+            self._entries[key] = embeddings
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embeddings
+
+    def stats(self):
+        """
+        Return the hit and miss counters and the estimated encoder time saved by hits, in seconds.
+        """
+        with self._lock:
+            average = self.encode_seconds / self.misses if self.misses else 0.0
+            return {"hits": self.hits, "misses": self.misses, "saved_seconds": self.hits * average}
+
+
+def stats_delta(before, after):
+    """
+    Return the difference between two stats() snapshots, e.g. for a single request.
+    """
+    return {key: after[key] - before[key] for key in after}
+
+
+prompt_embedding_cache = PromptEmbeddingCache(max_entries=int(os.getenv("PROMPT_EMBEDDING_CACHE_SIZE", "128")))
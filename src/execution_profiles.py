@@ -0,0 +1,97 @@
+import os
+from collections import namedtuple
+
+# How the inpainting pipeline is run on a host: device and weight dtype, the diffusers memory savers
+# to enable, CPU offloading (None, "model" or "sequential") and the largest batch that fits
+ExecutionProfile = namedtuple(
+    "ExecutionProfile",
+    ["name", "device", "dtype", "attention_slicing", "vae_slicing", "vae_tiling", "offload", "max_batch_size"],
+)
+
+PROFILES = {
+    # 24 GB and up: everything stays on the GPU, large batches
+    "cuda-large": ExecutionProfile("cuda-large", "cuda", "float16", False, False, False, None, 8),
+    # 16 GB: sliced VAE decode keeps batches of 4 in memory
+    "cuda-medium": ExecutionProfile("cuda-medium", "cuda", "float16", False, True, False, None, 4),
+    # 10 GB: only the model currently running is moved to the GPU
+    "cuda-small": ExecutionProfile("cuda-small", "cuda", "float16", True, True, True, "model", 1),
+    # Below 10 GB: weights are streamed to the GPU layer by layer; slow but fits almost anywhere
+    "cuda-minimal": ExecutionProfile("cuda-minimal", "cuda", "float16", True, True, True, "sequential", 1),
+    # No GPU: float32 on the host, since float16 kernels are missing or slow on most CPUs
+    "cpu": ExecutionProfile("cpu", "cpu", "float32", False, True, True, None, 1),
+}
+
+# Smallest GPU memory, in GB, for each CUDA profile, largest first
+_CUDA_THRESHOLDS_GB = [("cuda-large", 22), ("cuda-medium", 14), ("cuda-small", 9.5), ("cuda-minimal", 0)]
+
+
+def _host_memory_gb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+def select_profile(name=None):
+    """
+    Choose the execution profile for this host.
+
+    Parameters:
+    - name: Name of a profile in PROFILES. Defaults to the EXECUTION_PROFILE environment variable; when
+      neither is set (or it is "auto"), the profile is picked from the available GPU or host memory.
+
+    Returns:
+    - The ExecutionProfile. DIFFUSION_MAX_BATCH_SIZE, when set, overrides its batch size.
+    """
+    name = name or os.getenv("EXECUTION_PROFILE", "auto")
+    if name != "auto":
+        if name not in PROFILES:
+            raise ValueError(f"Unknown execution profile: {name}. Choose one of auto, {', '.join(PROFILES)}.")
+        profile = PROFILES[name]
+    else:
+        import torch
+
+        if torch.cuda.is_available():
+            total_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+            profile = next(PROFILES[profile_name] for profile_name, minimum in _CUDA_THRESHOLDS_GB if total_gb >= minimum)
+        else:
+            # SDXL needs about 14 GB of host memory in float32; more memory allows small batches
+            profile = PROFILES["cpu"]._replace(max_batch_size=2 if _host_memory_gb() >= 48 else 1)
+
+    max_batch_size = os.getenv("DIFFUSION_MAX_BATCH_SIZE")
+    if max_batch_size:
+        profile = profile._replace(max_batch_size=int(max_batch_size))
+    return profile
+
+
+def torch_dtype(profile):
+    """
+    Return the torch dtype of a profile.
+    """
+    import torch
+
+    return getattr(torch, profile.dtype)
+
+
+def apply_profile(pipe, profile, device=None):
+    """
+    Place a freshly loaded pipeline according to the profile and enable its memory savers.
+
+    Parameters:
+    - pipe: Pipeline loaded on the host.
+    - profile: ExecutionProfile to apply.
+    - device: Device to use instead of profile.device, e.g. "cuda:1".
+    """
+    device = device or profile.device
+    if profile.attention_slicing:
+        pipe.enable_attention_slicing()
+    if profile.vae_slicing:
+        pipe.enable_vae_slicing()
+    if profile.vae_tiling:
+        pipe.enable_vae_tiling()
+
+    # Offloading moves each model to the GPU only while it runs, so the pipeline stays on the host
+    gpu_id = int(device.split(":")[1]) if ":" in device else 0
+    if profile.offload == "model":
+        pipe.enable_model_cpu_offload(gpu_id=gpu_id)
+    elif profile.offload == "sequential":
+        pipe.enable_sequential_cpu_offload(gpu_id=gpu_id)
+    else:
+        pipe.to(device)
@@ -0,0 +1,163 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import telemetry
+from common import atomic_write
+from site_context import image_hash
+
+
+def site_fingerprint(model, model_image, model_mask, size):
+    """
+    Return the part of an image's cache key shared by every image of a request: the model, the
+    hashes of the (cropped) site image and mask the model sees, and the size it generates at.
+    """
+    return {"model": model, "image": image_hash(model_image), "mask": image_hash(model_mask), "size": size}
+
+
+def generation_key(fingerprint, settings, item):
+    """
+    Return the content address of one generated image.
+
+    Parameters:
+    - fingerprint: site_fingerprint() of the request.
+    - settings: GenerationSettings the image is denoised with.
+    - item: WorkItem with the prompts and seed. Refined items also hash the draft latents they start from.
+    """
+    import numpy as np
+
+    inputs = {
+        **fingerprint,
+        "positive": item.positive,
+        "negative": item.negative,
+        "seed": item.seed,
+        "settings": settings._asdict(),
+    }
+    if item.latents is not None:
+        latents = item.latents.cpu().numpy() if hasattr(item.latents, "cpu") else np.asarray(item.latents)
+        inputs["latents"] = hashlib.sha256(latents.tobytes()).hexdigest()
+    payload = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """
+    Content-addressed on-disk store of generated images (and draft latents), capped in size.
+
+    Files are named after their generation key, so an entry can only ever be served for exactly the
+    inputs it was generated from. The least recently used entries are removed when the directory
+    grows beyond max_bytes; file modification times record use, so the order survives restarts.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # key -> total bytes of its files, oldest use first
+        entries = {}
+        for name in os.listdir(directory):
+            key, extension = os.path.splitext(name)
+            if extension in (".png", ".npy"):
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                used, size = entries.get(key, (0, 0))
+                entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        self._entries = OrderedDict(
+            (key, size) for key, (_, size) in sorted(entries.items(), key=lambda entry: entry[1][0])
+        )
+        self._total_bytes = sum(self._entries.values())
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key):
+        """
+        Return the (PIL.Image, latents) stored for key, or None on a miss. latents is a numpy array
+        for drafts and None otherwise.
+        """
+        import numpy as np
+
+        try:
+            with Image.open(self._path(key, ".png")) as stored:
+                image = stored.copy()
+            latents_path = self._path(key, ".npy")
+            latents = np.load(latents_path) if os.path.exists(latents_path) else None
+            os.utime(self._path(key, ".png"))
+        except (OSError, ValueError):
+            # Missing, or evicted by another process sharing the directory
+            with self._lock:
+                self.misses += 1
+            telemetry.count("cache_misses_total", cache="image")
+            return None
+
+        telemetry.count("cache_hits_total", cache="image")
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return image, latents
+
+    def _write(self, key, extension, save):
+        with atomic_write(self._path(key, extension), "wb") as file:
+            save(file)
+        return os.path.getsize(self._path(key, extension))
+
+    def put(self, key, image, latents=None):
+        """
+        Store a generated image, and the draft latents it was decoded from, under key.
+        """
+        import numpy as np
+
+        # Latents first, so an entry whose image is present is always complete
+        size = 0
+        if latents is not None:
+            latents = latents.cpu().numpy() if hasattr(latents, "cpu") else latents
+            size += self._write(key, ".npy", lambda file: np.save(file, latents))
+        size += self._write(key, ".png", lambda file: image.save(file, format="PNG"))
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                for extension in (".png", ".npy"):
+                    try:
+                        os.remove(self._path(evicted, extension))
+                    except OSError:
+                        pass
+
+    def lookup(self, fingerprint, settings, work_items):
+        """
+        Return a (key, cached entry or None) pair for every work item of a request.
+        """
+        keys = [generation_key(fingerprint, settings, item) for item in work_items]
+        return [(key, self.get(key)) for key in keys]
+
+    def stats(self):
+        """
+        Return the hit and miss counters, the number of entries and their total size in bytes.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._total_bytes}
+
+
+@functools.lru_cache(maxsize=None)
+def default_image_cache():
+    """
+    Return the process-wide image cache in IMAGE_CACHE_DIR, capped at IMAGE_CACHE_MAX_GB, or None
+    when the directory is set to an empty value.
+    """
+    directory = os.getenv("IMAGE_CACHE_DIR", ".cache/images")
+    if not directory:
+        return None
+    return ImageCache(directory, int(float(os.getenv("IMAGE_CACHE_MAX_GB", "5")) * 1024**3))
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import weakref
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+
+def _encode_png(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class MemorySink:
+    """
+    Keep generated images in memory as PIL images. PNG bytes are only encoded when asked for.
+    """
+
+    def __init__(self):
+        self.prompt_list = []
+        self._results = OrderedDict()
+        self._encoded = {}
+
+    def begin(self, prompt_list):
+        self.prompt_list = list(prompt_list)
+
+    def add(self, result):
+        self._results[(result.concept, result.index)] = result
+        self._encoded.pop((result.concept, result.index), None)
+
+    def results(self, concept=None):
+        """
+        Return the stored GeneratedImage tuples, optionally only those of one concept.
+        """
+        return [result for result in self._results.values() if concept is None or result.concept == concept]
+
+    def png_bytes(self, concept, index):
+        """
+        Return the PNG encoding of one image, encoding it on first request.
+        """
+        key = (concept, index)
+        if key not in self._encoded:
+            self._encoded[key] = _encode_png(self._results[key].image)
+        return self._encoded[key]
+
+    def zip_bytes(self):
+        """
+        Return a zip archive with every image and a prompts.txt per concept, laid out like ArchiveSink.
+        """
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for idea in self.prompt_list:
+                archive.writestr(f"{idea['concept']}/prompts.txt", _prompts_text(idea))
+            for concept, index in self._results:
+                archive.writestr(f"{concept}/generated_image_{index}.png", self.png_bytes(concept, index))
+        return buffer.getvalue()
+
+    def close(self):
+        self._results.clear()
+        self._encoded.clear()
+
+
+def _prompts_text(idea):
+    return f"Positive prompt: {idea['positive']}\nNegative prompt: {idea['negative']}"
+
+
+class ArchiveSink:
+    """
+    Persist generated images under output_path, one folder per concept with its prompts.txt.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+
+    def _concept_path(self, concept):
+        return os.path.join(self.output_path, concept)
+
+    def begin(self, prompt_list):
+        # make folder for each idea with the name of the concept
+        for idea in prompt_list:
+            os.makedirs(self._concept_path(idea["concept"]), exist_ok=True)
+
+            # Save the positive and negative prompts as text file in the same folder
+            with open(os.path.join(self._concept_path(idea["concept"]), "prompts.txt"), "w") as file:
+                file.write(_prompts_text(idea))
+
+    def add(self, result):
+        os.makedirs(self._concept_path(result.concept), exist_ok=True)
+        result.image.save(os.path.join(self._concept_path(result.concept), f"generated_image_{result.index}.png"))
+
+    def close(self):
+        pass
+
+
+class TempDirSink(ArchiveSink):
+    """
+    Write generated images to a private temporary directory that is removed on close or garbage collection.
+    """
+
+    def __init__(self, prefix="design_concepts_"):
+        super().__init__(tempfile.mkdtemp(prefix=prefix))
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.output_path, True)
+
+    def close(self):
+        self._cleanup()
+
+
+def make_sink(kind="memory", output_path=None):
+    """
+    Create an output sink.
+
+    Parameters:
+    - kind: "memory", "tempdir" or "archive".
+    - output_path: Directory for the "archive" sink.
+
+    Returns:
+    - The sink object.
+    """
+    if kind == "memory":
+        return MemorySink()
+    if kind == "tempdir":
+        return TempDirSink()
+    if kind == "archive":
+        if not output_path:
+            raise ValueError("The archive sink needs an output_path.")
+        return ArchiveSink(output_path)
+    raise ValueError(f"Unknown sink kind: {kind}")
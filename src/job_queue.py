@@ -0,0 +1,498 @@
+import itertools
+import multiprocessing
+import queue
+import threading
+from collections import OrderedDict, deque, namedtuple
+
+import telemetry
+from embedding_cache import stats_delta
+from image_cache import default_image_cache, site_fingerprint
+from utils import (
+    DRAFT,
+    FULL_QUALITY,
+    QUALITY_SETTINGS,
+    REFINE,
+    build_work_items,
+    plan_site,
+    refine_work_items,
+    to_generated_image,
+)
+
+# Settings a job can be run with; "refine" jobs start from draft latents
+JOB_SETTINGS = {"full": FULL_QUALITY, "draft": DRAFT, "refine": REFINE}
+
+# What the worker needs to run a job: the settings name, the (cropped) site image and mask, the size to
+# generate at and the work items. The original photo never leaves the UI process.
+JobSpec = namedtuple("JobSpec", ["settings", "model_image", "model_mask", "size", "items"])
+
+_DONE = object()
+
+
+class GenerationError(RuntimeError):
+    """
+    Raised when the worker could not run a job.
+    """
+
+
+class _Job:
+    def __init__(self, total, finish, quality, cache_keys=None, parts=None):
+        self.total = total
+        self.finish = finish
+        self.quality = quality
+        # (concept, index) -> image cache key of every item sent to the worker
+        self.cache_keys = cache_keys or {}
+        # worker -> number of the job's images that worker has still to generate
+        self.parts = parts or {}
+        self.state = "queued"
+        self.done = 0
+        self.error = None
+        self.results = queue.Queue()
+        # Spans of the worker's batches that included this job, to attach to the caller's request
+        self.spans = deque()
+        # Prompt embedding cache stats_delta over the job's time on its workers, once it is done
+        self.prompt_embedding_stats = {"hits": 0, "misses": 0, "saved_seconds": 0.0}
+
+
+class _WorkerJob:
+    def __init__(self, settings, site, items, embedding_stats):
+        self.settings = settings
+        self.site = site
+        self.items = deque(items)
+        self.started = False
+        # The prompt embedding cache's stats when the job arrived
+        self.embedding_stats = embedding_stats
+
+
+def _next_batch(jobs, max_batch_size):
+    # The oldest job with work left decides the settings and size of the batch; every other job that
+    # can share the pipeline call takes turns filling it, so a large job does not starve small ones
+    first = next((job for job in jobs.values() if job.items), None)
+    if first is None:
+        return []
+    key = (first.settings, first.site.size)
+    compatible = [(job_id, job) for job_id, job in jobs.items() if job.items and (job.settings, job.site.size) == key]
+
+    batch = []
+    while len(batch) < max_batch_size and any(job.items for _, job in compatible):
+        for job_id, job in compatible:
+            if job.items and len(batch) < max_batch_size:
+                batch.append((job_id, job.items.popleft()))
+
+    # Keep each job's items together, so repeated prompts still collapse into num_images_per_prompt
+    order = {job_id: position for position, job_id in enumerate(jobs)}
+    return sorted(batch, key=lambda entry: order[entry[0]])
+
+
+def _worker_main(worker, model, device, max_batch_size, requests, events):
+    # Runs in a worker process, each with its own pipeline on its own device. Every event is tagged
+    # with the worker it comes from
+    import torch
+
+    from embedding_cache import prompt_embedding_cache
+    from execution_profiles import select_profile
+    from pipeline_registry import get_pipeline
+    from site_context import site_context_cache
+    from utils import run_batch
+
+    # Spans are sent to the UI process with the results, instead of being exported from here
+    telemetry.collect()
+    try:
+        pipe = get_pipeline(model, device=device)
+    except Exception as e:
+        events.put((worker, "failed", None, f"{type(e).__name__}: {e}"))
+        return
+    max_batch_size = max_batch_size or select_profile().max_batch_size
+    # The visible GPUs are counted here, so the UI process never imports torch
+    events.put((worker, "ready", None, (torch.cuda.device_count(), telemetry.drain())))
+
+    jobs = OrderedDict()
+    while True:
+        # Block only when idle; otherwise take whatever was submitted while the last batch ran
+        messages = [] if any(job.items for job in jobs.values()) else [requests.get()]
+        while True:
+            try:
+                messages.append(requests.get_nowait())
+            except queue.Empty:
+                break
+
+        for message in messages:
+            if message is None:
+                return
+            kind, job_id, spec = message
+            if kind == "cancel":
+                jobs.pop(job_id, None)
+                continue
+            try:
+                # Encoded once per job; identical sites of different sessions share the cached context
+                with telemetry.span("worker.prepare", job=job_id):
+                    site = site_context_cache.get(pipe, spec.model_image, spec.model_mask, spec.size)
+            except Exception as e:
+                events.put((worker, "error", job_id, f"{type(e).__name__}: {e}"))
+                continue
+            events.put((worker, "telemetry", [job_id], telemetry.drain()))
+            jobs[job_id] = _WorkerJob(spec.settings, site, spec.items, prompt_embedding_cache.stats())
+
+        batch = _next_batch(jobs, max_batch_size)
+        if not batch:
+            continue
+        for job_id, _ in batch:
+            if not jobs[job_id].started:
+                jobs[job_id].started = True
+                events.put((worker, "started", job_id, None))
+
+        batch_job_ids = list(dict.fromkeys(job_id for job_id, _ in batch))
+        try:
+            with telemetry.span("worker.batch", images=len(batch), jobs=len(batch_job_ids)):
+                outputs = run_batch(
+                    pipe,
+                    [item for _, item in batch],
+                    [jobs[job_id].site for job_id, _ in batch],
+                    JOB_SETTINGS[jobs[batch[0][0]].settings],
+                )
+        except Exception as e:
+            for job_id in batch_job_ids:
+                events.put((worker, "error", job_id, f"{type(e).__name__}: {e}"))
+                jobs.pop(job_id, None)
+            continue
+        # Before the images, so the spans are attached by the time the caller sees the job finish
+        events.put((worker, "telemetry", batch_job_ids, telemetry.drain()))
+
+        for (job_id, item), (image, latents) in zip(batch, outputs):
+            # Latents cross the process boundary as numpy arrays, so the UI process never imports torch
+            events.put((worker, "image", job_id, (item, image, None if latents is None else latents.numpy())))
+        for job_id in batch_job_ids:
+            if not jobs[job_id].items:
+                finished = jobs.pop(job_id)
+                # Jobs sharing batches share these counts; they are what the cache did while the job ran
+                events.put((worker, "done", job_id, {"before": finished.embedding_stats, "after": prompt_embedding_cache.stats()}))
+
+
+class GenerationService:
+    """
+    Local job queue in front of worker processes that own the inpainting pipeline, one per device.
+
+    Every Streamlit session submits its generation jobs here instead of running the pipeline in its
+    script thread. The concepts of every job are spread over the workers, and each worker coalesces
+    the work items it was given into shared batches, so concurrent users fill the devices instead of
+    competing for them. Jobs are passed through multiprocessing queues; no outside broker is needed.
+
+    Without explicit devices, one worker starts on the execution profile's device. Once it has
+    loaded the model, a worker is started for every other visible GPU.
+    """
+
+    def __init__(self, model, max_batch_size=None, poll_interval=0.5, devices=None):
+        """
+        Parameters:
+        - model: Hugging Face repo ID of the inpainting model.
+        - max_batch_size: Images per pipeline call. Defaults to the execution profile's.
+        - poll_interval: Seconds between on_status calls while a job waits.
+        - devices: One device per worker, e.g. ["cuda:0", "cuda:1"]. Defaults to every visible GPU.
+        """
+        # spawn, because CUDA cannot be initialised in a forked child
+        self._context = multiprocessing.get_context("spawn")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.poll_interval = poll_interval
+        self.ready = False
+        self._discover = devices is None
+        self._failure = None
+        # Latest prompt embedding cache stats of every worker
+        self._embedding_stats = {}
+        self._events = self._context.Queue()
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # One requests queue, process, count of images still to generate and loaded flag per worker
+        self._requests = []
+        self._processes = []
+        self._load = []
+        self._loaded = []
+        for device in devices or [None]:
+            self._start_worker(device)
+        threading.Thread(target=self._dispatch, name="generation-dispatch", daemon=True).start()
+
+    def _start_worker(self, device):
+        worker = len(self._processes)
+        requests = self._context.Queue()
+        # Exiting must not wait for jobs to be delivered to a worker that has stopped
+        requests.cancel_join_thread()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(worker, self.model, device, self.max_batch_size, requests, self._events),
+            name=f"generation-worker-{worker}",
+            daemon=True,
+        )
+        process.start()
+        with self._lock:
+            self._requests.append(requests)
+            self._processes.append(process)
+            self._load.append(0)
+            self._loaded.append(False)
+
+    def _stopped(self):
+        return [process for process in self._processes if not process.is_alive()]
+
+    def _fail_all(self, message):
+        with self._lock:
+            self._failure = message
+            for job in self._jobs.values():
+                if job.state in ("queued", "running"):
+                    job.state, job.error = "failed", message
+                    job.results.put(_DONE)
+
+    def _release(self, job_id, job):
+        # Called with the lock held: the job's workers drop whatever is left of it
+        for worker, remaining in job.parts.items():
+            self._load[worker] -= remaining
+            self._requests[worker].put(("cancel", job_id, None))
+        job.parts = {}
+
+    def _dispatch(self):
+        # Routes the workers' events to the jobs they belong to
+        while True:
+            try:
+                worker, kind, job_id, payload = self._events.get(timeout=1.0)
+            except queue.Empty:
+                stopped = self._stopped()
+                if stopped:
+                    codes = ", ".join(f"{process.name}: {process.exitcode}" for process in stopped)
+                    self._fail_all(f"The generation worker stopped (exit code {codes}).")
+                    return
+                continue
+
+            if kind == "ready":
+                num_gpus, loaded = payload
+                with self._lock:
+                    self._loaded[worker] = True
+                self.ready = True
+                # The pipeline load belongs to no request, so it is exported on its own
+                telemetry.merge_counters(loaded["counters"])
+                for loaded_span in loaded["spans"]:
+                    telemetry.attach(loaded_span)
+                if self._discover and worker == 0:
+                    # The first worker runs on the first GPU; the others get a worker each
+                    for gpu in range(1, num_gpus):
+                        self._start_worker(f"cuda:{gpu}")
+                continue
+            if kind == "telemetry":
+                # Counters once for the process; the batch's spans go to every job that was in it
+                telemetry.merge_counters(payload["counters"])
+                for other_id in job_id:
+                    other = self._jobs.get(other_id)
+                    if other is not None:
+                        other.spans.extend(payload["spans"])
+                continue
+            if kind == "failed":
+                self._fail_all(f"The generation worker could not load {self.model}: {payload}")
+                return
+
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or worker not in job.parts:
+                    # Cancelled while the worker was still running its last batch
+                    continue
+                if kind == "started":
+                    if job.state == "queued":
+                        job.state = "running"
+                elif kind == "image":
+                    item, image, latents = payload
+                    key = job.cache_keys.get((item.concept, item.index))
+                    if key is not None:
+                        default_image_cache().put(key, image, latents)
+                    job.results.put(to_generated_image(item, job.finish(image), job.quality, latents))
+                    job.done += 1
+                    job.parts[worker] -= 1
+                    self._load[worker] -= 1
+                elif kind == "done":
+                    self._embedding_stats[worker] = payload["after"]
+                    delta = stats_delta(payload["before"], payload["after"])
+                    for key in job.prompt_embedding_stats:
+                        job.prompt_embedding_stats[key] += delta[key]
+                    del job.parts[worker]
+                    if not job.parts:
+                        job.state = "done"
+                        job.results.put(_DONE)
+                elif kind == "error":
+                    job.state, job.error = "failed", payload
+                    self._release(job_id, job)
+                    job.results.put(_DONE)
+
+    def _submit(self, settings, items, image, mask, crop_to_mask, context_padding, quality):
+        stopped = self._stopped()
+        if self._failure or stopped:
+            raise GenerationError(self._failure or f"The generation worker is not running (exit code {stopped[0].exitcode}).")
+        model_image, model_mask, size, finish = plan_site(image, mask, crop_to_mask, context_padding, JOB_SETTINGS[settings].scale)
+
+        # Cached images are answered here; only the rest is queued for the workers
+        cache = default_image_cache()
+        cached, cache_keys = [], {}
+        if cache is not None:
+            lookups = cache.lookup(site_fingerprint(self.model, model_image, model_mask, size), JOB_SETTINGS[settings], items)
+            for item, (key, entry) in zip(items, lookups):
+                if entry is None:
+                    cache_keys[(item.concept, item.index)] = key
+                else:
+                    cached.append((item, entry))
+            items = [item for item in items if (item.concept, item.index) in cache_keys]
+
+        job = _Job(len(items) + len(cached), finish, quality, cache_keys)
+        for item, (generated_image, latents) in cached:
+            job.results.put(to_generated_image(item, finish(generated_image), quality, latents))
+            job.done += 1
+        with self._lock:
+            job_id = next(self._ids)
+            self._jobs[job_id] = job
+            # Each concept goes to the loaded worker with the fewest images still to generate,
+            # keeping its images together so repeated prompts still share pipeline calls. Until
+            # one has loaded, everything waits for the first
+            workers = [worker for worker, loaded in enumerate(self._loaded) if loaded] or [0]
+            assigned = {}
+            concepts = OrderedDict()
+            for item in items:
+                concepts.setdefault(item.concept, []).append(item)
+            for concept_items in concepts.values():
+                worker = min(workers, key=lambda worker: self._load[worker])
+                assigned.setdefault(worker, []).extend(concept_items)
+                self._load[worker] += len(concept_items)
+            job.parts = {worker: len(worker_items) for worker, worker_items in assigned.items()}
+            for worker, worker_items in assigned.items():
+                self._requests[worker].put(("submit", job_id, JobSpec(settings, model_image, model_mask, size, worker_items)))
+        if not items:
+            job.state = "done"
+            job.results.put(_DONE)
+        return job_id
+
+    def submit(self, prompt_list, image, mask, num_output_images, seed=0, crop_to_mask=None, context_padding=None, quality="full"):
+        """
+        Queue the images of every concept for generation.
+
+        Parameters:
+        - See utils.iter_images_from_prompts.
+
+        Returns:
+        - The job ID, for status() and iter_results().
+        """
+        if quality not in QUALITY_SETTINGS:
+            raise ValueError(f"Unknown quality: {quality}. Choose one of {', '.join(QUALITY_SETTINGS)}.")
+        items = build_work_items(prompt_list, num_output_images, seed)
+        return self._submit(quality, items, image, mask, crop_to_mask, context_padding, quality)
+
+    def submit_refine(self, drafts, image, mask, crop_to_mask=None, context_padding=None):
+        """
+        Queue selected drafts for refinement at full quality. See utils.iter_refined_images.
+
+        Returns:
+        - The job ID.
+        """
+        return self._submit("refine", refine_work_items(drafts), image, mask, crop_to_mask, context_padding, "full")
+
+    def status(self, job_id):
+        """
+        Return the state of a job as a dict with:
+        - state: "queued", "running", "done" or "failed".
+        - position: Number of unfinished jobs submitted before it, while it is queued.
+        - done, total: Images finished and requested.
+        - error: The worker's error message if the job failed.
+        """
+        with self._lock:
+            job = self._jobs[job_id]
+            position = 0
+            if job.state == "queued":
+                for other_id, other in self._jobs.items():
+                    if other_id == job_id:
+                        break
+                    position += other.state in ("queued", "running")
+            return {"state": job.state, "position": position, "done": job.done, "total": job.total, "error": job.error}
+
+    def cancel(self, job_id):
+        """
+        Drop a job's remaining work items and forget the job.
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None:
+                self._release(job_id, job)
+
+    def iter_results(self, job_id, on_status=None, on_stats=None):
+        """
+        Yield the GeneratedImage tuples of a job as the worker finishes them.
+
+        Parameters:
+        - job_id: ID returned by submit() or submit_refine().
+        - on_status: Called with status() while waiting, e.g. to show the queue position.
+        - on_stats: Called once the job is done with the prompt embedding cache's hits, misses and
+          saved_seconds while the job was on its workers.
+
+        Raises:
+        - GenerationError if the job failed.
+
+        Closing the generator early (e.g. when a Streamlit rerun stops the script) cancels the job.
+        """
+        job = self._jobs[job_id]
+        try:
+            while True:
+                try:
+                    entry = job.results.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if on_status is not None:
+                        on_status(self.status(job_id))
+                    continue
+                # The worker's spans join whatever span the caller is in, e.g. its request
+                while job.spans:
+                    telemetry.attach(job.spans.popleft())
+                if entry is _DONE:
+                    if on_stats is not None and not job.error:
+                        on_stats(dict(job.prompt_embedding_stats))
+                    break
+                yield entry
+                if on_status is not None:
+                    on_status(self.status(job_id))
+            if job.error:
+                raise GenerationError(job.error)
+        finally:
+            self.cancel(job_id)
+
+    def iter_images_from_prompts(self, prompt_list, image, mask, num_output_images, model=None, max_batch_size=None, seed=0, crop_to_mask=None, context_padding=None, quality="full", on_status=None, on_stats=None):
+        """
+        Drop-in replacement for utils.iter_images_from_prompts that runs on the worker. model and
+        max_batch_size are accepted for compatibility; the worker's own are used.
+        """
+        job_id = self.submit(prompt_list, image, mask, num_output_images, seed, crop_to_mask, context_padding, quality)
+        yield from self.iter_results(job_id, on_status, on_stats)
+
+    def iter_refined_images(self, drafts, image, mask, model=None, max_batch_size=None, crop_to_mask=None, context_padding=None, on_status=None, on_stats=None):
+        """
+        Drop-in replacement for utils.iter_refined_images that runs on the worker.
+        """
+        job_id = self.submit_refine(drafts, image, mask, crop_to_mask, context_padding)
+        yield from self.iter_results(job_id, on_status, on_stats)
+
+    def stats(self):
+        """
+        Return the number of queued and running jobs, the number of workers and the prompt
+        embedding cache stats summed over the workers.
+        """
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+            workers = len(self._processes)
+            worker_stats = list(self._embedding_stats.values())
+        return {
+            "queued": states.count("queued"),
+            "running": states.count("running"),
+            "workers": workers,
+            "prompt_embeddings": {
+                key: sum(stats[key] for stats in worker_stats) for key in ("hits", "misses", "saved_seconds")
+            },
+        }
+
+    def close(self, timeout=10):
+        """
+        Stop every worker after its current batch.
+        """
+        with self._lock:
+            self._discover = False
+            requests, processes = list(self._requests), list(self._processes)
+        for worker_requests in requests:
+            worker_requests.put(None)
+        for process in processes:
+            process.join(timeout)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from langchain.globals import get_llm_cache, set_llm_cache
+from langchain_community.chat_models import ChatOpenAI
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+import telemetry
+from common import sqlite_connection
+
+
+class BoundedLLMCache(BaseCache):
+    """
+    LangChain LLM cache with a size-bounded in-memory LRU in front of an optional SQLite store.
+
+    Entries are keyed on the serialized messages and the llm_string, which LangChain builds from the
+    model parameters (model name, temperature, stop words, ...).
+    """
+
+    def __init__(self, max_entries=1000, path=None, max_persistent_entries=100000):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_persistent_entries = max_persistent_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with sqlite_connection(self.path) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, generations TEXT, accessed_at REAL)"
+                )
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, generations):
+        self._memory[key] = generations
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                telemetry.count("cache_hits_total", cache="llm")
+                return self._memory[key]
+
+            if self.path:
+                with sqlite_connection(self.path) as conn:
+                    row = conn.execute("SELECT generations FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+                        generations = loads(row[0])
+                        self._remember(key, generations)
+                        self.hits += 1
+                        telemetry.count("cache_hits_total", cache="llm")
+                        return generations
+
+            self.misses += 1
+            telemetry.count("cache_misses_total", cache="llm")
+            return None
+
+    def update(self, prompt, llm_string, return_val):
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            self._remember(key, return_val)
+            if self.path:
+                with sqlite_connection(self.path) as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+                        (key, dumps(return_val), time.time()),
+                    )
+                    conn.execute(
+                        "DELETE FROM llm_cache WHERE key IN ("
+                        "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                        (self.max_persistent_entries,),
+                    )
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._memory.clear()
+            if self.path:
+                with sqlite_connection(self.path) as conn:
+                    conn.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        """
+        Return the hit and miss counters since the cache was created.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def install_llm_cache():
+    """
+    Install the process-wide LLM cache, configured from the environment, if it is not installed yet.
+
+    Returns:
+    - The installed BoundedLLMCache.
+    """
+    cache = get_llm_cache()
+    if not isinstance(cache, BoundedLLMCache):
+        # An empty LLM_CACHE_PATH keeps the cache in memory only
+        cache = BoundedLLMCache(
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000")),
+            path=os.getenv("LLM_CACHE_PATH", ".cache/llm_cache.sqlite") or None,
+        )
+        set_llm_cache(cache)
+    return cache
+
+
+def cached_chat_model(model_name="gpt-4-0125-preview", **kwargs):
+    """
+    Create the chat model used by ArchitectureDesignCrew with the LLM cache installed.
+    """
+    install_llm_cache()
+    return ChatOpenAI(model_name=model_name, **kwargs)
@@ -0,0 +1,169 @@
+import os
+import threading
+from collections import OrderedDict
+
+import telemetry
+from execution_profiles import apply_profile, select_profile, torch_dtype
+
+# torch and diffusers are imported inside the functions that need them, so importing this module
+# from the Streamlit script stays cheap
+
+
+def _default_memory_budget(device):
+    import torch
+
+    # Explicit budget from the environment wins, otherwise use the size of the target memory pool
+    budget_gb = os.getenv("PIPELINE_MEMORY_BUDGET_GB")
+    if budget_gb:
+        return int(float(budget_gb) * 1024**3)
+    if device.startswith("cuda") and torch.cuda.is_available():
+        return torch.cuda.get_device_properties(torch.device(device)).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def _pipeline_size(pipe):
+    import torch
+
+    # Sum the parameter and buffer bytes of every torch module in the pipeline
+    size = 0
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class PipelineRegistry:
+    """
+    Process-wide cache of loaded pipelines keyed by (repo_id, dtype, device, execution profile, pipeline class).
+
+    Pipelines stay loaded across Streamlit reruns and sessions. Every device has its own memory budget
+    (host memory for offloaded pipelines); when loading a new pipeline would exceed it, the least
+    recently used pipelines on that device are evicted first. Loads of different pipelines run in parallel.
+    """
+
+    def __init__(self, memory_budget_bytes=None):
+        self.memory_budget_bytes = memory_budget_bytes
+        # key -> (pipeline, size in bytes, device whose memory holds its weights)
+        self._pipelines = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per key being loaded, so a load only blocks callers waiting for the same pipeline
+        self._loading = {}
+        # Bytes of pipelines still being loaded, per memory device
+        self._reserved = {}
+
+    def get(self, repo_id, profile=None, device=None, pipeline_class=None):
+        """
+        Return a loaded pipeline, loading it on first use.
+
+        Parameters:
+        - repo_id: Hugging Face repo ID or local path of the model.
+        - profile: ExecutionProfile deciding the device, dtype and memory savers. Defaults to select_profile().
+        - device: Device to use instead of the profile's, e.g. "cuda:1".
+        - pipeline_class: Diffusers pipeline class used to load the model. Defaults to StableDiffusionXLInpaintPipeline.
+
+        Returns:
+        - The loaded pipeline, placed according to the profile.
+        """
+        if pipeline_class is None:
+            from diffusers import StableDiffusionXLInpaintPipeline as pipeline_class
+
+        profile = profile or select_profile()
+        device = device or profile.device
+        key = (repo_id, profile.dtype, device, profile.name, pipeline_class.__name__)
+
+        with self._lock:
+            pipe = self._lookup(key)
+            if pipe is not None:
+                return pipe
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                # Loaded by another caller while this one waited
+                pipe = self._lookup(key)
+                if pipe is not None:
+                    return pipe
+
+            # Offloaded weights live in host memory
+            memory_device = "cpu" if profile.offload else device
+            reserved = 0
+            try:
+                with telemetry.span("pipeline.load", model=repo_id, device=str(device), profile=profile.name) as load:
+                    # Weights load on the host first, so the size is known before making room on the device
+                    pipe = pipeline_class.from_pretrained(repo_id, torch_dtype=torch_dtype(profile))
+                    size = _pipeline_size(pipe)
+                    with self._lock:
+                        self._evict_for(size, memory_device)
+                        self._reserved[memory_device] = self._reserved.get(memory_device, 0) + size
+                        reserved = size
+                    apply_profile(pipe, profile, device)
+                    load.set(bytes=size)
+                with self._lock:
+                    self._pipelines[key] = (pipe, size, memory_device)
+                return pipe
+            finally:
+                with self._lock:
+                    if reserved:
+                        self._reserved[memory_device] -= reserved
+                    self._loading.pop(key, None)
+
+    def _lookup(self, key):
+        # Called with the lock held
+        if key not in self._pipelines:
+            return None
+        self._pipelines.move_to_end(key)
+        return self._pipelines[key][0]
+
+    def _evict_for(self, size, device):
+        # Called with the lock held. Only pipelines whose weights share the device's memory count
+        # against its budget
+        import torch
+
+        budget = self.memory_budget_bytes or _default_memory_budget(device)
+        used = self._reserved.get(device, 0) + sum(
+            entry_size for _, entry_size, entry_device in self._pipelines.values() if entry_device == device
+        )
+        evicted = False
+        for key, (_, entry_size, entry_device) in list(self._pipelines.items()):
+            if used + size <= budget:
+                break
+            if entry_device != device:
+                continue
+            del self._pipelines[key]
+            used -= entry_size
+            evicted = True
+            telemetry.count("pipeline_evictions_total", device=str(key[2]))
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, repo_id=None):
+        """
+        Drop loaded pipelines, either all of them or only those of the given repo_id.
+        """
+        import torch
+
+        with self._lock:
+            for key in list(self._pipelines):
+                if repo_id is None or key[0] == repo_id:
+                    del self._pipelines[key]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def loaded(self):
+        """
+        Return the keys of the loaded pipelines, least recently used first.
+        """
+        with self._lock:
+            return list(self._pipelines)
+
+
+registry = PipelineRegistry()
+
+
+def get_pipeline(repo_id, profile=None, device=None, pipeline_class=None):
+    """
+    Return a pipeline from the process-wide registry. See PipelineRegistry.get.
+    """
+    return registry.get(repo_id, profile=profile, device=device, pipeline_class=pipeline_class)
+
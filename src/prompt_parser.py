@@ -0,0 +1,168 @@
+import ast
+import json
+import re
+
+REQUIRED_KEYS = ("concept", "positive", "negative")
+
+
+class ConceptParseError(ValueError):
+    """
+    Raised when the prompt agent's output cannot be parsed into concept dictionaries.
+
+    Attributes:
+    - position: Offset in the parsed text where the problem starts, if known.
+    - fragment: The text that failed to parse, if any.
+    """
+
+    def __init__(self, message, position=None, fragment=None):
+        super().__init__(message)
+        self.position = position
+        self.fragment = fragment
+
+
+class IncrementalConceptParser:
+    """
+    Parse {"concept", "positive", "negative"} objects out of a list in text that arrives in chunks.
+
+    Each object is returned by feed() as soon as its closing brace arrives. Braces outside a list
+    and quotes outside objects (e.g. in the agent's reasoning) are ignored.
+    """
+
+    def __init__(self):
+        self.lists = []
+        self._position = 0
+        self._list_depth = 0
+        self._object_depth = 0
+        self._object_start = None
+        self._quote = None
+        self._escape = False
+        self._current = []
+        self._seen = set()
+
+    def feed(self, text):
+        """
+        Consume the next chunk of text.
+
+        Returns:
+        - The list of concept dictionaries completed by this chunk, in order. Concepts already
+          returned earlier (e.g. when the agent repeats its answer) are skipped.
+
+        Raises:
+        - ConceptParseError if a completed object is not a valid concept dictionary.
+        """
+        completed = []
+        for char in text:
+            self._position += 1
+            if self._object_depth:
+                self._current.append(char)
+                if self._quote:
+                    if self._escape:
+                        self._escape = False
+                    elif char == "\\":
+                        self._escape = True
+                    elif char == self._quote:
+                        self._quote = None
+                elif char in "\"'":
+                    self._quote = char
+                elif char == "{":
+                    self._object_depth += 1
+                elif char == "}":
+                    self._object_depth -= 1
+                    if not self._object_depth:
+                        fragment = "".join(self._current)
+                        self._current = []
+                        idea = self._parse_object(fragment)
+                        if idea["concept"] not in self._seen:
+                            self._seen.add(idea["concept"])
+                            self.lists[-1].append(idea)
+                            completed.append(idea)
+            elif char == "[":
+                if not self._list_depth:
+                    self.lists.append([])
+                self._list_depth += 1
+            elif char == "]" and self._list_depth:
+                self._list_depth -= 1
+            elif char == "{" and self._list_depth:
+                self._object_depth = 1
+                self._object_start = self._position - 1
+                self._current = [char]
+        return completed
+
+    def _parse_object(self, fragment):
+        try:
+            idea = json.loads(fragment)
+        except ValueError:
+            try:
+                # Fall back to Python literal syntax, e.g. single-quoted strings
+                idea = ast.literal_eval(fragment)
+            except (ValueError, SyntaxError) as e:
+                raise ConceptParseError(f"Error parsing concept: {e}", self._object_start, fragment) from e
+        if not isinstance(idea, dict):
+            raise ConceptParseError("Concept is not a dictionary", self._object_start, fragment)
+        missing = [key for key in REQUIRED_KEYS if not isinstance(idea.get(key), str)]
+        if missing:
+            raise ConceptParseError(f"Concept is missing {', '.join(missing)}", self._object_start, fragment)
+        return {key: idea[key] for key in REQUIRED_KEYS}
+
+    def close(self):
+        """
+        Signal the end of the text.
+
+        Returns:
+        - All parsed concept dictionaries.
+
+        Raises:
+        - ConceptParseError if the text ends inside an object or contains no concepts at all.
+        """
+        if self._object_depth:
+            raise ConceptParseError("Text ended inside a concept", self._object_start, "".join(self._current))
+        concepts = [idea for parsed_list in self.lists for idea in parsed_list]
+        if not concepts:
+            raise ConceptParseError("No list of dictionaries found in the string.")
+        return concepts
+
+
+def parse_concepts(text):
+    """
+    Parse every concept dictionary in text. See IncrementalConceptParser.
+    """
+    parser = IncrementalConceptParser()
+    parser.feed(text)
+    return parser.close()
+
+
+# A heading starting a concept: "Concept N" after "#"s, bold or numbering, then ":", "-" or the
+# end of the line, e.g. "1. Concept 1: ...", "**Concept 2 - ...**" or "### Concept 3". Prose that
+# merely starts with "Concept 3 is ..." is not a heading
+_CONCEPT_HEADING = re.compile(
+    r"^[ \t]*(?:#+[ \t]*(?:\*\*)?|\d+[.)][ \t]*(?:\*\*)?|\*\*)Concept[ \t]+\d+[ \t]*(?:\*\*)?[ \t]*(?:[:\-\u2013\u2014]|$)",
+    re.M | re.I,
+)
+# Otherwise every unindented numbered item, e.g. "1. The Folded Roof: ..."
+_NUMBERED_ITEM = re.compile(r"^[#*]*\s?\d+[.)]\s", re.M)
+
+
+def _split_at(pattern, text):
+    starts = [match.start() for match in pattern.finditer(text)]
+    return [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)])]
+
+
+def split_concepts(text, expected=None):
+    """
+    Split the concept agent's answer into one text per concept, so each can be prompted on its own.
+
+    Parameters:
+    - text: The concept agent's answer.
+    - expected: Number of concepts asked for. The answer is only split when it has exactly this
+      many concepts; without concept headings, it is split at its numbered items only when given.
+
+    Returns:
+    - The text of every concept, including its heading, in order. Text before the first concept is
+      left out. An empty list if the concepts cannot be told apart.
+    """
+    concepts = _split_at(_CONCEPT_HEADING, text)
+    if concepts:
+        return concepts if expected is None or len(concepts) == expected else []
+    concepts = _split_at(_NUMBERED_ITEM, text)
+    # Numbered lists inside a concept would otherwise be split apart
+    return concepts if expected is not None and len(concepts) == expected else []
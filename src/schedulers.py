@@ -0,0 +1,52 @@
+import inspect
+import threading
+import weakref
+
+# Names accepted wherever a scheduler can be chosen, mapped to their diffusers class names.
+# None keeps the scheduler the model ships with.
+SCHEDULERS = {
+    "default": None,
+    "dpm++": "DPMSolverMultistepScheduler",
+    "dpm++_karras": "DPMSolverMultistepScheduler",
+    "euler": "EulerDiscreteScheduler",
+    "euler_a": "EulerAncestralDiscreteScheduler",
+    "unipc": "UniPCMultistepScheduler",
+}
+
+# Keyed weakly by pipeline, so evicting a pipeline from the registry also frees its variants
+_variants = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def with_scheduler(pipe, name):
+    """
+    Return a pipeline that shares every weight of pipe but samples with the named scheduler.
+
+    The shared pipeline is never modified, so concurrent calls with different schedulers do not
+    interfere. Variants are created once per pipeline and scheduler.
+
+    Parameters:
+    - pipe: Loaded diffusers pipeline.
+    - name: Key of SCHEDULERS, or None for the pipeline's own scheduler.
+
+    Returns:
+    - The pipeline to call.
+    """
+    if name is None or SCHEDULERS.get(name) is None:
+        if name not in (None, "default"):
+            raise ValueError(f"Unknown scheduler: {name}. Choose one of {', '.join(SCHEDULERS)}.")
+        return pipe
+
+    with _lock:
+        variants = _variants.setdefault(pipe, {})
+        if name not in variants:
+            import diffusers
+
+            scheduler_class = getattr(diffusers, SCHEDULERS[name])
+            extra = {"use_karras_sigmas": True} if name.endswith("_karras") else {}
+            scheduler = scheduler_class.from_config(pipe.scheduler.config, **extra)
+            # Init options that are not components (e.g. force_zeros_for_empty_prompt) come from the config
+            parameters = inspect.signature(type(pipe).__init__).parameters
+            options = {key: value for key, value in pipe.config.items() if key in parameters and key not in pipe.components}
+            variants[name] = type(pipe)(**{**pipe.components, **options, "scheduler": scheduler})
+        return variants[name]
@@ -0,0 +1,289 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import telemetry
+from image_cache import default_image_cache, site_fingerprint
+from job_queue import JOB_SETTINGS, GenerationError, JobSpec
+from utils import QUALITY_SETTINGS, batch_work_items, build_work_items, plan_site, refine_work_items, to_generated_image
+
+
+def default_devices():
+    """
+    Return one device per worker: every visible GPU, or SHARD_CPU_WORKERS (default 2) CPU workers
+    when there is no GPU.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"] * int(os.getenv("SHARD_CPU_WORKERS", "2"))
+
+
+def _shard_worker(model, device, num_threads, sites, tasks, results):
+    # Runs in a worker process with its own pipeline on its own device
+    import torch
+
+    if num_threads:
+        # CPU workers split the cores between them instead of each using all of them
+        torch.set_num_threads(num_threads)
+
+    from pipeline_registry import get_pipeline
+    from site_context import site_context_cache
+    from utils import run_batch
+
+    # Spans are sent back with the results and attached to the request that asked for them
+    telemetry.collect()
+    try:
+        pipe = get_pipeline(model, device=device)
+    except Exception as e:
+        results.put(("failed", None, f"{device}: {type(e).__name__}: {e}"))
+        return
+    results.put(("ready", None, device))
+    results.put(("telemetry", None, telemetry.drain()))
+
+    # Every job's site arrives on this worker's own queue before its first task is queued, and a
+    # "cancel" message once its caller is no longer waiting for it
+    specs = {}
+    cancelled = OrderedDict()
+
+    def receive(message):
+        kind, job_id, spec = message
+        if kind == "site":
+            specs[job_id] = spec
+        else:
+            specs.pop(job_id, None)
+            cancelled[job_id] = True
+            while len(cancelled) > 1024:
+                cancelled.popitem(last=False)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, positions, items = task
+        while True:
+            try:
+                receive(sites.get_nowait())
+            except queue.Empty:
+                break
+        while job_id not in specs and job_id not in cancelled:
+            receive(sites.get())
+        if job_id in cancelled:
+            # Nobody waits for these images any more
+            continue
+        spec = specs[job_id]
+
+        try:
+            with telemetry.span("worker.batch", device=device, images=len(items)):
+                site = site_context_cache.get(pipe, spec.model_image, spec.model_mask, spec.size)
+                outputs = run_batch(pipe, items, site, JOB_SETTINGS[spec.settings])
+        except Exception as e:
+            results.put(("error", job_id, f"{device}: {type(e).__name__}: {e}"))
+            continue
+        results.put(("telemetry", job_id, telemetry.drain()))
+        results.put((
+            "images",
+            job_id,
+            [
+                (position, item, image, None if latents is None else latents.numpy())
+                for position, item, (image, latents) in zip(positions, items, outputs)
+            ],
+        ))
+
+
+class ShardedExecutor:
+    """
+    Data-parallel image generation: one worker process per device, each with its own pipeline.
+
+    Work items are split into batches on a single shared queue. Each worker pulls the next batch as
+    soon as it finishes the last one, so faster devices take more of the work and a slow one never
+    holds the others up. Results are yielded in work item order whatever worker produced them, and
+    every image is reproducible from its own seed, so the output does not depend on the sharding.
+
+    Several threads can generate through one executor at the same time: a dispatcher thread routes
+    every worker result to the job it belongs to.
+    """
+
+    def __init__(self, model, devices=None, threads_per_worker=None, max_batch_size=None):
+        """
+        Parameters:
+        - model: Hugging Face repo ID of the inpainting model.
+        - devices: One device per worker, e.g. ["cuda:0", "cuda:1"] or ["cpu"] * 4. Defaults to default_devices().
+        - threads_per_worker: torch threads of each CPU worker. Defaults to the cores divided between the CPU workers.
+        - max_batch_size: Images per pipeline call. Defaults to the execution profile's.
+        """
+        from execution_profiles import select_profile
+
+        self.model = model
+        self.devices = devices or default_devices()
+        self.max_batch_size = max_batch_size or select_profile().max_batch_size
+        num_cpu_workers = sum(device == "cpu" for device in self.devices)
+        if threads_per_worker is None and num_cpu_workers:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_cpu_workers)
+
+        # spawn, because CUDA cannot be initialised in a forked child
+        context = multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._sites = [context.Queue() for _ in self.devices]
+        # Exiting must not wait for work to be delivered to workers that have stopped
+        for worker_queue in [self._tasks, *self._sites]:
+            worker_queue.cancel_join_thread()
+        self._ids = itertools.count(1)
+        # job ID -> queue of (kind, payload) results for the caller waiting on that job
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._failure = None
+        self._closed = False
+        self._processes = [
+            context.Process(
+                target=_shard_worker,
+                args=(model, device, threads_per_worker if device == "cpu" else None, sites, self._tasks, self._results),
+                name=f"shard-worker-{i}",
+                daemon=True,
+            )
+            for i, (device, sites) in enumerate(zip(self.devices, self._sites))
+        ]
+        for process in self._processes:
+            process.start()
+        threading.Thread(target=self._dispatch, name="shard-dispatch", daemon=True).start()
+
+    def _fail_all(self, message):
+        with self._lock:
+            self._failure = message
+            for results in self._jobs.values():
+                results.put(("error", message))
+
+    def _dispatch(self):
+        # Routes the workers' results to the jobs they belong to
+        while True:
+            try:
+                kind, job_id, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                stopped = [process.name for process in self._processes if not process.is_alive()]
+                if self._closed:
+                    return
+                if stopped:
+                    self._fail_all(f"Workers stopped: {', '.join(stopped)}")
+                    return
+                continue
+
+            if kind == "failed":
+                self._fail_all(f"A worker could not load {self.model}: {payload}")
+                return
+            if kind == "telemetry":
+                telemetry.merge_counters(payload["counters"])
+                if job_id is None:
+                    # Pipeline loads belong to no request, so they are exported on their own
+                    for worker_span in payload["spans"]:
+                        telemetry.attach(worker_span)
+                    continue
+                payload = payload["spans"]
+            with self._lock:
+                results = self._jobs.get(job_id)
+            # Results of a job whose caller stopped waiting are dropped
+            if results is not None:
+                results.put((kind, payload))
+
+    def _run(self, settings, work_items, image, mask, crop_to_mask, context_padding, quality):
+        model_image, model_mask, size, finish = plan_site(image, mask, crop_to_mask, context_padding, JOB_SETTINGS[settings].scale)
+        job_id = next(self._ids)
+
+        # Cached images never reach a worker; they are yielded in their turn with the generated ones
+        cache = default_image_cache()
+        if cache is not None:
+            lookups = cache.lookup(site_fingerprint(self.model, model_image, model_mask, size), JOB_SETTINGS[settings], work_items)
+        else:
+            lookups = [(None, None)] * len(work_items)
+        positions = [position for position, (_, entry) in enumerate(lookups) if entry is None]
+
+        results = queue.Queue()
+        if positions:
+            with self._lock:
+                if self._failure:
+                    raise GenerationError(self._failure)
+                self._jobs[job_id] = results
+            spec = JobSpec(settings, model_image, model_mask, size, None)
+            for sites in self._sites:
+                sites.put(("site", job_id, spec))
+            for batch in batch_work_items(positions, self.max_batch_size):
+                self._tasks.put((job_id, batch, [work_items[position] for position in batch]))
+
+        try:
+            yield from self._gather(results, work_items, lookups, finish, quality)
+        finally:
+            if positions:
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                # Workers skip the batches nobody is waiting for any more, e.g. when the caller
+                # stopped early, and forget the job's site
+                for sites in self._sites:
+                    sites.put(("cancel", job_id, None))
+
+    def _gather(self, results, work_items, lookups, finish, quality):
+        # Results arrive in whatever order the workers finish; hold them back until it is their turn
+        pending = {position: entry for position, (_, entry) in enumerate(lookups) if entry is not None}
+        next_position = 0
+        while True:
+            while next_position in pending:
+                generated_image, latents = pending.pop(next_position)
+                yield to_generated_image(work_items[next_position], finish(generated_image), quality, latents)
+                next_position += 1
+            if next_position == len(work_items):
+                return
+
+            kind, payload = results.get()
+            if kind == "telemetry":
+                # The worker's spans join whatever span the caller is in, e.g. its request
+                for worker_span in payload:
+                    telemetry.attach(worker_span)
+                continue
+            if kind == "error":
+                raise GenerationError(payload)
+            if kind != "images":
+                continue
+
+            for position, _, generated_image, latents in payload:
+                pending[position] = (generated_image, latents)
+                key = lookups[position][0]
+                if key is not None:
+                    default_image_cache().put(key, generated_image, latents)
+
+    def iter_images_from_prompts(self, prompt_list, image, mask, num_output_images, model=None, max_batch_size=None, seed=0, crop_to_mask=None, context_padding=None, quality="full"):
+        """
+        Drop-in replacement for utils.iter_images_from_prompts that spreads the images over the workers.
+        model and max_batch_size are accepted for compatibility; the executor's own are used.
+
+        Yields:
+        - GeneratedImage tuples in the same order as utils.iter_images_from_prompts.
+        """
+        if quality not in QUALITY_SETTINGS:
+            raise ValueError(f"Unknown quality: {quality}. Choose one of {', '.join(QUALITY_SETTINGS)}.")
+        work_items = build_work_items(prompt_list, num_output_images, seed)
+        yield from self._run(quality, work_items, image, mask, crop_to_mask, context_padding, quality)
+
+    def iter_refined_images(self, drafts, image, mask, model=None, max_batch_size=None, crop_to_mask=None, context_padding=None):
+        """
+        Drop-in replacement for utils.iter_refined_images that spreads the drafts over the workers.
+        """
+        yield from self._run("refine", refine_work_items(drafts), image, mask, crop_to_mask, context_padding, "full")
+
+    def close(self, timeout=10):
+        """
+        Stop every worker after its current batch.
+        """
+        self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import telemetry
+
+# The preprocessed site shared by every generation of a request: the VAE latents of the image and of
+# the masked image, the binarized mask tensor and the (width, height) they were prepared at
+SiteContext = namedtuple("SiteContext", ["key", "image_latents", "masked_image_latents", "mask", "size"])
+
+
+def image_hash(image):
+    """
+    Return a hash of the pixels, mode and size of a PIL image.
+    """
+    digest = hashlib.sha1(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def default_size(pipe):
+    """
+    Return the (width, height) the pipeline generates at when none is given.
+    """
+    side = pipe.unet.config.sample_size * pipe.vae_scale_factor
+    return side, side
+
+
+def build_site_context(pipe, image, mask, size=None, key=None):
+    """
+    Preprocess the site image and mask and encode them with the VAE, as the pipeline would on every call.
+
+    Parameters:
+    - pipe: Loaded inpainting pipeline.
+    - image: PIL.Image object of the site (or of the crop being inpainted).
+    - mask: PIL.Image object of the mask, the same size as image.
+    - size: (width, height) to generate at. Defaults to the model's native square size.
+    - key: Cache key to record on the context.
+
+    Returns:
+    - A SiteContext whose tensors can be passed straight to the pipeline.
+    """
+    import torch
+
+    width, height = size or default_size(pipe)
+    device = pipe._execution_device
+    dtype = pipe.unet.dtype
+
+    init_image = pipe.image_processor.preprocess(image.convert("RGB"), height=height, width=width).to(dtype=torch.float32)
+    mask_tensor = pipe.mask_processor.preprocess(mask.convert("L"), height=height, width=width)
+    masked_image = init_image * (mask_tensor < 0.5)
+
+    # A fixed generator makes the latents, and therefore every image of the site, reproducible
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    with torch.no_grad():
+        image_latents = pipe._encode_vae_image(init_image.to(device=device, dtype=dtype), generator=generator)
+        masked_image_latents = pipe._encode_vae_image(masked_image.to(device=device, dtype=dtype), generator=generator)
+
+    return SiteContext(key, image_latents, masked_image_latents.to(device=device, dtype=dtype), mask_tensor, (width, height))
+
+
+class SiteContextCache:
+    """
+    Small LRU cache of SiteContext objects keyed by (model, image hash, mask hash, size).
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pipe, image, mask, size=None):
+        """
+        Return the SiteContext for the image and mask, building it on a miss.
+        """
+        size = size or default_size(pipe)
+        # The same model loaded with another dtype or on another device has latents of its own
+        key = (pipe.name_or_path, pipe.dtype, str(pipe._execution_device), image_hash(image), image_hash(mask), size)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                telemetry.count("cache_hits_total", cache="site_context")
+                return self._entries[key]
+
+        telemetry.count("cache_misses_total", cache="site_context")
+        with telemetry.span("site.encode", width=size[0], height=size[1]):
+            site = build_site_context(pipe, image, mask, size, key)
+        with self._lock:
+            self._entries[key] = site
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return site
+
+
+site_context_cache = SiteContextCache(max_entries=int(os.getenv("SITE_CONTEXT_CACHE_SIZE", "4")))
@@ -0,0 +1,88 @@
+"""
+Measure the cold-start import cost of the app.
+
+Every module group is imported in a fresh interpreter, so the numbers are what a new container pays
+the first time a page is rendered (UI path) and the first time Submit is pressed (Submit path).
+Per-rerun latency is shown live in the app's sidebar.
+
+Usage, from the src directory:
+    python startup_report.py [--repeat 3]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULE_GROUPS = {
+    "UI path (first page load)": [
+        "streamlit",
+        "numpy",
+        "PIL.Image",
+        "streamlit_drawable_canvas",
+        "dotenv",
+        "utils",
+        "archi_tasks",
+        "pipeline_registry",
+        "job_queue",
+        "telemetry",
+        "image_sinks",
+        "prompt_parser",
+    ],
+    "Submit path (first Submit)": [
+        "archi_crew",
+        "concept_pipeline",
+        "llm_cache",
+    ],
+    "Diffusion (first pipeline load)": [
+        "torch",
+        "diffusers",
+    ],
+}
+
+_MEASURE = """
+import importlib, json, sys, time
+timings = {}
+for name in sys.argv[1:]:
+    started = time.perf_counter()
+    importlib.import_module(name)
+    timings[name] = time.perf_counter() - started
+print(json.dumps(timings))
+"""
+
+
+def measure(modules, preload=()):
+    # preload is imported first (and not counted), as it is already loaded when these modules are
+    result = subprocess.run(
+        [sys.executable, "-c", _MEASURE, *preload, *modules],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    timings = json.loads(result.stdout)
+    return {name: timings[name] for name in modules}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Number of fresh interpreters per group; the fastest run is reported")
+    args = parser.parse_args()
+
+    preload = []
+    for group, modules in MODULE_GROUPS.items():
+        try:
+            runs = [measure(modules, preload) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{group}: could not import ({e})")
+            continue
+        best = {name: min(run[name] for run in runs) for name in modules}
+        print(f"{group}: {sum(best.values()) * 1000:.0f} ms")
+        for name, seconds in sorted(best.items(), key=lambda item: -item[1]):
+            print(f"    {name:<28} {seconds * 1000:8.1f} ms")
+        preload += modules
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Timing spans and counters for every stage of a request.
+
+Spans nest through a context variable, so a span opened while another is active becomes its child,
+including in threads started with propagate(). A finished top-level span (usually a whole request) is
+written to TELEMETRY_JSONL_PATH, one line per span, and the metrics to TELEMETRY_PROMETHEUS_PATH in
+the Prometheus text format. Worker processes collect() their spans instead and send them to the
+process that asked for the work, which attach()es them to its own request.
+
+With TELEMETRY=false every call returns straight away and nothing is recorded.
+"""
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+
+from common import atomic_write, env_flag
+
+ENABLED = env_flag("TELEMETRY", "true")
+METRIC_PREFIX = "design_assistant_"
+
+_current = contextvars.ContextVar("telemetry_span", default=None)
+_lock = threading.Lock()
+# (name, sorted label items) -> value
+_counters = {}
+# span name -> [count, total seconds]
+_durations = {}
+# Finished top-level spans, when this process hands its spans to another one
+_collected = None
+_drained_counters = {}
+
+
+class Span:
+    """
+    A timed, named unit of work with attributes and child spans.
+    """
+
+    __slots__ = ("name", "attributes", "parent", "children", "started_at", "seconds", "_started", "_token")
+
+    def __init__(self, name, attributes, parent=None, started_at=None, seconds=None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.children = []
+        self.started_at = started_at
+        self.seconds = seconds
+
+    def set(self, **attributes):
+        """
+        Add or replace attributes, e.g. results only known at the end of the work.
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        if self.parent is not None:
+            with _lock:
+                self.parent.children.append(self)
+        self._token = _current.set(self)
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.seconds = time.perf_counter() - self._started
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Exited in another context than it was entered in, e.g. by a generator closed elsewhere
+            _current.set(self.parent)
+        _finish(self)
+        return False
+
+    def to_dict(self):
+        """
+        Return the span and its children as nested plain data.
+        """
+        with _lock:
+            children = list(self.children)
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "attributes": self.attributes,
+            "children": [child.to_dict() for child in children],
+        }
+
+    @classmethod
+    def from_dict(cls, data, parent=None):
+        span = cls(data["name"], dict(data["attributes"]), parent, data["started_at"], data["seconds"])
+        span.children = [cls.from_dict(child, span) for child in data["children"]]
+        return span
+
+
+class _NullSpan:
+    # Returned when telemetry is disabled, so instrumented code needs no checks of its own
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **attributes):
+    """
+    Return a context manager timing the work inside it as a child of the current span.
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return Span(name, attributes, _current.get())
+
+
+def current_span():
+    """
+    Return the innermost open span, or None.
+    """
+    return _current.get() if ENABLED else None
+
+
+def record(name, seconds, **attributes):
+    """
+    Add an already finished span to the current span, for work timed by someone else (e.g. a
+    callback that only sees the end of each step).
+    """
+    if not ENABLED:
+        return
+    parent = _current.get()
+    finished = Span(name, attributes, parent, time.time() - seconds, seconds)
+    if parent is not None:
+        with _lock:
+            parent.children.append(finished)
+    _finish(finished)
+
+
+def count(name, value=1, **labels):
+    """
+    Add value to a counter, e.g. count("cache_hits_total", cache="image").
+    """
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def propagate(function):
+    """
+    Return function wrapped to run in a copy of the caller's context, so spans it opens in another
+    thread nest under the caller's current span.
+    """
+    if not ENABLED:
+        return function
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(function, *args, **kwargs)
+
+    return run
+
+
+def _observe(finished):
+    with _lock:
+        totals = _durations.setdefault(finished.name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += finished.seconds
+
+
+def _finish(finished):
+    _observe(finished)
+    if finished.parent is not None:
+        return
+    if _collected is not None:
+        data = finished.to_dict()
+        with _lock:
+            _collected.append(data)
+        return
+    export(finished)
+
+
+def collect():
+    """
+    Keep finished top-level spans in memory instead of exporting them; drain() hands them over.
+    For worker processes whose work belongs to a request of another process.
+    """
+    global _collected
+    _collected = []
+
+
+def drain():
+    """
+    Return and forget the spans collected, and the counter increments, since the last drain().
+    """
+    global _collected
+    with _lock:
+        spans = _collected or []
+        if _collected is not None:
+            _collected = []
+        counters = {}
+        for key, value in _counters.items():
+            if value != _drained_counters.get(key, 0):
+                counters[key] = value - _drained_counters.get(key, 0)
+                _drained_counters[key] = value
+    return {"spans": spans, "counters": list(counters.items())}
+
+
+def merge_counters(counters):
+    """
+    Add counter increments drained from another process.
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        for key, value in counters:
+            key = (key[0], tuple(tuple(label) for label in key[1]))
+            _counters[key] = _counters.get(key, 0) + value
+
+
+def attach(data):
+    """
+    Add a span drained from another process, and all its children, under the current span.
+    """
+    if not ENABLED:
+        return
+    parent = _current.get()
+    attached = Span.from_dict(data, parent)
+    if parent is not None:
+        with _lock:
+            parent.children.append(attached)
+
+    pending = [attached]
+    while pending:
+        finished = pending.pop()
+        _observe(finished)
+        pending.extend(finished.children)
+    if parent is None:
+        export(attached)
+
+
+def breakdown(root):
+    """
+    Summarise a span tree for display: spans with the same path from the root are merged.
+
+    Returns:
+    - A list of {"span", "depth", "count", "seconds"} dicts in the order the spans first started,
+      where span is the name and depth the number of ancestors below root.
+    """
+    rows = {}
+
+    def visit(node, path):
+        path = path + (node.name,)
+        row = rows.setdefault(path, {"span": node.name, "depth": len(path) - 1, "count": 0, "seconds": 0.0})
+        row["count"] += 1
+        row["seconds"] += node.seconds or 0.0
+        with _lock:
+            children = sorted(node.children, key=lambda child: child.started_at or 0.0)
+        for child in children:
+            visit(child, path)
+
+    visit(root, ())
+    return list(rows.values())
+
+
+def _flatten(node, trace_id, parent_id, ids):
+    span_id = next(ids)
+    yield {
+        "trace_id": trace_id,
+        "span_id": span_id,
+        "parent_id": parent_id,
+        "name": node["name"],
+        "started_at": node["started_at"],
+        "seconds": node["seconds"],
+        "attributes": node["attributes"],
+    }
+    for child in node["children"]:
+        yield from _flatten(child, trace_id, span_id, ids)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def prometheus_text():
+    """
+    Return every counter and the span durations in the Prometheus text exposition format.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        durations = sorted((name, list(totals)) for name, totals in _durations.items())
+
+    lines = []
+    declared = set()
+    for (name, labels), value in counters:
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+        lines.append(f"{METRIC_PREFIX}{name}{_labels(labels)} {value}")
+    if durations:
+        lines.append(f"# TYPE {METRIC_PREFIX}span_seconds summary")
+        for name, (number, seconds) in durations:
+            lines.append(f"{METRIC_PREFIX}span_seconds_count{_labels([('span', name)])} {number}")
+            lines.append(f"{METRIC_PREFIX}span_seconds_sum{_labels([('span', name)])} {seconds:.6f}")
+    return "\n".join(lines) + "\n"
+
+
+def export(root):
+    """
+    Append a finished top-level span to TELEMETRY_JSONL_PATH and rewrite TELEMETRY_PROMETHEUS_PATH.
+    Both are skipped when their variable is not set.
+    """
+    jsonl_path = os.getenv("TELEMETRY_JSONL_PATH")
+    if jsonl_path:
+        lines = [
+            json.dumps(row, default=str)
+            for row in _flatten(root.to_dict(), uuid.uuid4().hex, None, itertools.count(1))
+        ]
+        with _lock, open(jsonl_path, "a") as file:
+            file.write("\n".join(lines) + "\n")
+
+    prometheus_path = os.getenv("TELEMETRY_PROMETHEUS_PATH")
+    if prometheus_path:
+        # Replaced atomically, so a scraper never reads half a file
+        with atomic_write(prometheus_path) as file:
+            file.write(prometheus_text())
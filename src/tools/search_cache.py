@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from tavily import TavilyClient
+
+import telemetry
+from common import sqlite_connection
+
+
+def normalise_query(query):
+  """Lower-case the query, collapse whitespace and drop trailing punctuation
+  so trivially different phrasings share a cache entry"""
+  query = re.sub(r"\s+", " ", str(query)).strip().lower()
+  return query.rstrip(" ?!.")
+
+
+def _search_timeout():
+  return float(os.getenv("SEARCH_TIMEOUT_SECONDS", "30"))
+
+
+class TavilySearchBackend():
+  """Search backend backed by one shared TavilyClient"""
+
+  def __init__(self, search_depth="advanced", timeout=None):
+    self.search_depth = search_depth
+    self.timeout = timeout or _search_timeout()
+    self._client = None
+    self._lock = threading.Lock()
+
+  @property
+  def client(self):
+    # Created once and reused by every search
+    with self._lock:
+      if self._client is None:
+        self._client = TavilyClient(api_key=os.environ['TAVILY_API_KEY'])
+      return self._client
+
+  def search(self, query, max_results):
+    client = self.client
+    # TavilyClient.search waits up to 100 seconds for an answer, so the request is sent here with
+    # the search timeout; a query given up on then stops holding its thread soon after
+    response = requests.post(
+      client.base_url,
+      data=json.dumps({
+        "query": query,
+        "search_depth": self.search_depth,
+        "max_results": max_results,
+        "api_key": client.api_key,
+      }),
+      headers=client.headers,
+      timeout=self.timeout,
+    )
+    response.raise_for_status()
+    return [obj["content"] for obj in response.json()["results"]]
+
+
+class SearchCache():
+  """SQLite store of search results with a TTL and a cap on the number of entries.
+  The least recently used entries are evicted first once the cap is reached."""
+
+  def __init__(self, path, ttl_seconds, max_entries):
+    self.path = path
+    self.ttl_seconds = ttl_seconds
+    self.max_entries = max_entries
+    if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    with sqlite_connection(self.path) as conn:
+      conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_cache ("
+        "key TEXT PRIMARY KEY, query TEXT, results TEXT, created_at REAL, accessed_at REAL)"
+      )
+
+  def get(self, key):
+    now = time.time()
+    with sqlite_connection(self.path) as conn:
+      row = conn.execute("SELECT results, created_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      if now - row[1] > self.ttl_seconds:
+        conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+        return None
+      conn.execute("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key))
+      return json.loads(row[0])
+
+  def set(self, key, query, results):
+    now = time.time()
+    with sqlite_connection(self.path) as conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?, ?)",
+        (key, query, json.dumps(results), now, now),
+      )
+      conn.execute("DELETE FROM search_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+      conn.execute(
+        "DELETE FROM search_cache WHERE key IN ("
+        "SELECT key FROM search_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+        (self.max_entries,),
+      )
+
+
+class CachedSearch():
+  """Search front end: normalises the query, serves it from the cache when possible
+  and coalesces concurrent identical lookups into a single backend call"""
+
+  def __init__(self, backend, cache):
+    self.backend = backend
+    self.cache = cache
+    self._in_flight = {}
+    self._lock = threading.Lock()
+
+  def search(self, query, max_results=3):
+    normalised = normalise_query(query)
+    key = hashlib.sha256(f"{type(self.backend).__name__}:{max_results}:{normalised}".encode("utf-8")).hexdigest()
+
+    results = self.cache.get(key)
+    if results is not None:
+      telemetry.count("cache_hits_total", cache="search")
+      return results
+    telemetry.count("cache_misses_total", cache="search")
+
+    with self._lock:
+      in_flight = self._in_flight.get(key)
+      leader = in_flight is None
+      if leader:
+        in_flight = {"done": threading.Event(), "results": None, "error": None}
+        self._in_flight[key] = in_flight
+
+    if not leader:
+      in_flight["done"].wait()
+      if in_flight["error"] is not None:
+        raise in_flight["error"]
+      return in_flight["results"]
+
+    try:
+      # A leader that finished just before this one took over has stored its results by now
+      results = self.cache.get(key)
+      if results is None:
+        with telemetry.span("search.query", backend=type(self.backend).__name__):
+          results = self.backend.search(normalised, max_results)
+        self.cache.set(key, normalised, results)
+      in_flight["results"] = results
+      return results
+    except Exception as e:
+      in_flight["error"] = e
+      raise
+    finally:
+      with self._lock:
+        del self._in_flight[key]
+      in_flight["done"].set()
+
+
+_search = None
+_search_lock = threading.Lock()
+
+
+def get_search():
+  """Return the process-wide CachedSearch, configured from the environment on first use"""
+  global _search
+  with _search_lock:
+    if _search is None:
+      cache = SearchCache(
+        os.getenv("SEARCH_CACHE_PATH", ".cache/search_cache.sqlite"),
+        ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL_HOURS", "168")) * 3600,
+        max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "10000")),
+      )
+      _search = CachedSearch(TavilySearchBackend(), cache)
+    return _search
+
+
+def set_search_backend(backend):
+  """Replace the search backend, e.g. with a local fake in tests. Cached results
+  are keyed by backend class, so a fake never serves Tavily results or vice versa"""
+  get_search().backend = backend
+
+
+def search_many(queries, max_results=3, max_workers=None, timeout=None):
+  """Run several searches concurrently, at most max_workers in flight, counting searches that
+  timed out but have not returned yet. Returns a list of (query, results, error) in the order
+  of the queries. A query that fails or does not finish within timeout seconds of its own
+  start gets an error message instead of results, so one slow query cannot hold up the others"""
+  max_workers = max_workers or int(os.getenv("SEARCH_CONCURRENCY", "5"))
+  timeout = timeout or _search_timeout()
+  search = get_search()
+
+  executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+  outcomes = [None] * len(queries)
+  waiting = deque(enumerate(queries))
+  # future -> (index of the query, deadline)
+  running = {}
+  # future -> time it is taken for hung, of the searches that timed out but still hold their
+  # thread, and their slot, until they return
+  abandoned = {}
+  while waiting or running:
+    abandoned = {future: hung_at for future, hung_at in abandoned.items() if not future.done()}
+    while waiting and len(running) + len(abandoned) < max_workers:
+      index, query = waiting.popleft()
+      # Each search runs in the caller's context, so its span nests under the caller's
+      future = executor.submit(telemetry.propagate(search.search), query, max_results)
+      running[future] = (index, time.monotonic() + timeout)
+
+    now = time.monotonic()
+    deadlines = [deadline for _, deadline in running.values()]
+    deadlines += [hung_at for hung_at in abandoned.values() if hung_at > now]
+    if not deadlines:
+      # Every slot is held by a search that never returned; the queries left cannot be run
+      for index, query in waiting:
+        outcomes[index] = (query, [], "not searched, every search slot is held by a hung search")
+      break
+    # With every slot held by abandoned searches, wait for one of them to return
+    done, _ = wait([*running, *abandoned], timeout=max(0, min(deadlines) - now), return_when=FIRST_COMPLETED)
+    now = time.monotonic()
+    for future, (index, deadline) in list(running.items()):
+      query = queries[index]
+      if future in done:
+        try:
+          outcomes[index] = (query, future.result(), None)
+        except Exception as e:
+          outcomes[index] = (query, [], str(e))
+      elif deadline <= now:
+        outcomes[index] = (query, [], f"timed out after {timeout:g}s")
+        # Its HTTP timeout has ended it long before then, unless it hung
+        abandoned[future] = deadline + timeout
+      else:
+        continue
+      del running[future]
+  # Do not wait for stragglers; their results still land in the cache when they finish
+  executor.shutdown(wait=False, cancel_futures=True)
+  return outcomes
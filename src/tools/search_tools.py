@@ -1,9 +1,9 @@
-import json
-import os
+import re
 
-import requests
 from langchain.tools import tool
-from tavily import TavilyClient
+
+import telemetry
+from tools.search_cache import get_search, search_many
 
 class SearchTools():
 
@@ -12,12 +12,30 @@ class SearchTools():
     """Useful to search the internet
     about a a given topic and return relevant results"""
     top_result_to_return = 3
-    tavily = TavilyClient(api_key=os.environ['TAVILY_API_KEY'])
-    response = tavily.search(query=query, search_depth="advanced", max_results=top_result_to_return)
-    context = [obj["content"] for obj in response["results"]] 
+    # Served from the persistent search cache when the same question was asked before
+    with telemetry.span("tool.search_internet"):
+      context = get_search().search(query, max_results=top_result_to_return)
     context = '\n'.join(context)
 
     return context
 
+  @tool("Search the internet for several questions")
+  def search_internet_bulk(questions):
+    """Useful to research several questions at once. The input is all the
+    questions, one question per line. Returns the findings for every question"""
+    top_result_to_return = 3
+    # One question per line, dropping list numbering such as "1." or "-"
+    queries = [re.sub(r"^\s*(\d+[.)]|[-*])\s*", "", line).strip() for line in questions.splitlines()]
+    queries = [query for query in queries if query]
+
+    findings = []
+    with telemetry.span("tool.search_internet_bulk", questions=len(queries)):
+      outcomes = search_many(queries, max_results=top_result_to_return)
+    for query, results, error in outcomes:
+      answer = '\n'.join(results) if error is None else f"No results ({error})"
+      findings.append(f"Question: {query}\n{answer}")
+
+    return '\n\n'.join(findings)
+
 if __name__ == "__main__":
-  print(SearchTools.search_internet("What is the capital of USA?"))
\ No newline at end of file
+  print(SearchTools.search_internet("What is the capital of USA?"))
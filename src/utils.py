@@ -1,39 +1,38 @@
-import re
-import ast
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageChops, ImageFilter, ImageOps
 import requests
 from io import BytesIO
-import matplotlib.pyplot as plt
-from diffusers import StableDiffusionInpaintPipeline, StableDiffusionXLInpaintPipeline
-import torch
 import os
+import hashlib
+import math
+import time
+from collections import namedtuple
+
+import telemetry
+from common import env_flag
+from embedding_cache import EMBEDDING_KWARGS, prompt_embedding_cache
+from execution_profiles import select_profile
+from image_cache import default_image_cache, site_fingerprint
+from image_sinks import ArchiveSink
+from pipeline_registry import get_pipeline
+from prompt_parser import IncrementalConceptParser
+from schedulers import with_scheduler
+from site_context import site_context_cache
 
 # Parsing
 def extract_and_parse_list_of_dicts(text):
-    # Adjust the regex pattern to account for optional spaces and newline characters
-    # around the curly braces and commas. This pattern is more flexible and can match
-    # lists of dictionaries with various spacings and newline characters.
-    pattern = r"\[\s*\n?\{.*?\}\s*\n?\]"
-    
-    # Use non-greedy matching for the content inside the curly braces and allow for multiple
-    # dictionaries by including commas and optional spaces/newlines in the pattern.
-    # The pattern uses re.DOTALL to match across multiple lines.
-    matches = re.findall(pattern, text, re.DOTALL)
-    
-    parsed_lists = []
-    for match in matches:
-        try:
-            # Try to parse each extracted string using ast.literal_eval
-            result = ast.literal_eval(match)
-            parsed_lists.append(result)
-        except (ValueError, SyntaxError) as e:
-            # Handle exceptions raised by incorrect string format or content
-            return f"Error parsing extracted text: {e}"
-    
-    if parsed_lists:
-        return parsed_lists
-    else:
-        return "No list of dictionaries found in the string."
+    """
+    Extract the lists of {"concept", "positive", "negative"} dictionaries from the prompt agent's output.
+
+    Returns:
+    - A list with one list of concept dictionaries per list found in the text.
+
+    Raises:
+    - ConceptParseError if a concept cannot be parsed or no concepts are found.
+    """
+    parser = IncrementalConceptParser()
+    parser.feed(text)
+    parser.close()
+    return [parsed_list for parsed_list in parser.lists if parsed_list]
 
 # Image generation functions
     
@@ -50,6 +49,58 @@ def convert_image(image_path_or_url):
 
     return pil_image
 
+EXIF_ORIENTATION = 0x0112
+
+def oriented_size(image):
+    """
+    Return the (width, height) of an opened image once turned upright by its EXIF orientation,
+    read from the header without decoding any pixels.
+    """
+    width, height = image.size
+    # Orientations 5 to 8 rotate by 90 degrees, swapping width and height
+    if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+def open_site_image(data, max_width=None):
+    """
+    Decode an uploaded site photo, turned upright according to its EXIF orientation.
+
+    Parameters:
+    - data: The encoded image, e.g. the bytes of a JPEG or PNG upload.
+    - max_width: Width of a preview to decode instead of the full photo. JPEGs are then decoded at a
+      reduced scale (1/2, 1/4 or 1/8), which is much faster and smaller than decoding every pixel.
+
+    Returns:
+    - (PIL.Image, scale), where scale is the returned image's size relative to the full upright photo.
+    """
+    image = Image.open(BytesIO(data))
+    width, height = oriented_size(image)
+    scale = min(1.0, max_width / width) if max_width else 1.0
+    if scale < 1.0:
+        # The decoder picks the smallest scale still at least this large; non-JPEGs ignore it
+        image.draft(image.mode, (math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale)))
+    image = ImageOps.exif_transpose(image)
+    if scale < 1.0:
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+    return image, scale
+
+def rasterize_selection(points, size, scale=1.0):
+    """
+    Draw a selection polygon as a mask, only when generation needs one.
+
+    Parameters:
+    - points: (x, y) corner pixels of the selected area in the full photo; the edges are included.
+    - size: (width, height) of the mask.
+    - scale: Size of the mask relative to the full photo, e.g. to draw it for a preview.
+
+    Returns:
+    - A PIL.Image object in mode "L", white inside the selection.
+    """
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).polygon([(x * scale, y * scale) for x, y in points], fill=255)
+    return mask
+
 def generate_image_mask(image, top_left_ratio_x, top_left_ratio_y, bottom_right_ratio_x, bottom_right_ratio_y):
     """
     Generate a mask for the given PIL Image based on specified ratios for the top-left and bottom-right points of the mask.
@@ -127,53 +178,449 @@ def resize_generated_image_to_original(generated_img, original_img):
 
     return resized_generated_img
 
-def initialize_pipeline(model):
-    # Initialize the pipeline
-    pipe = StableDiffusionInpaintPipeline.from_pretrained(
-        model,
-        torch_dtype=torch.float16,)
-    pipe.to("cuda")
-    return pipe
-
-def generate_image_from_prompts(prompt_list, image, mask, num_output_images, output_path, model):
-    pipe = StableDiffusionXLInpaintPipeline.from_pretrained(
-        model,
-        torch_dtype=torch.float16,)
-    pipe.to("cuda")
-
-    # make output directory if it doesn't exist
-    os.makedirs(output_path, exist_ok=True)
-    for idea in prompt_list:
-        positive = idea["positive"]
-        negative = idea["negative"]
-        # make folder for each idea with the name of the concept
-        concept = idea["concept"]
-        concept_path = output_path + concept + "/"
-        os.makedirs(concept_path, exist_ok=True)
-
-        # Generate images
-        for i in range(num_output_images):
-            generated_image = pipe(
-                prompt=positive,
-                negative_prompt=negative,
-                image=image,
-                mask_image=mask,
-                guidance_scale=15,
-                num_inference_steps=20,  # steps between 15 and 30 work well for us
-                strength=0.99,).images[0]
+# Region-of-interest inpainting: only the masked area plus some context is sent to the model
+DEFAULT_CROP_TO_MASK = env_flag("INPAINT_CROP_TO_MASK", "true")
+DEFAULT_CONTEXT_PADDING = float(os.getenv("INPAINT_CONTEXT_PADDING", "0.25"))
+DEFAULT_FEATHER = int(os.getenv("INPAINT_FEATHER", "8"))
+# Pixel count crops are generated at; SDXL is trained on images of about one megapixel
+MODEL_PIXELS = int(os.getenv("INPAINT_MODEL_RESOLUTION", "1024")) ** 2
+# Longest side of a crop over its shortest; SDXL's training resolutions range from about 1:4 to 4:1
+MAX_CROP_ASPECT_RATIO = float(os.getenv("INPAINT_MAX_ASPECT_RATIO", "4"))
+
+def _grow_span(start, end, length, limit):
+    # Grow [start, end) to length around its centre, shifted back inside [0, limit)
+    length = min(limit, length)
+    start = max(0, min(start - (length - (end - start)) // 2, limit - length))
+    return start, start + length
+
+def compute_crop_box(bbox, image_size, context_padding=DEFAULT_CONTEXT_PADDING, multiple=8, max_aspect_ratio=MAX_CROP_ASPECT_RATIO):
+    """
+    Expand the mask bounding box by some context and align it to the model's size multiple.
+
+    Parameters:
+    - bbox: (left, top, right, bottom) bounding box of the mask, as returned by mask.getbbox().
+    - image_size: (width, height) of the original image.
+    - context_padding: Padding added on every side, as a fraction of the box's width and height.
+    - multiple: The crop's width and height are rounded to a multiple of this where the image allows it.
+    - max_aspect_ratio: A thinner crop takes more of the surrounding context on its short side.
+
+    Returns:
+    - The (left, top, right, bottom) crop box, inside the image.
+    """
+    image_width, image_height = image_size
+    left, top, right, bottom = bbox
+    pad_x = max(multiple, int((right - left) * context_padding))
+    pad_y = max(multiple, int((bottom - top) * context_padding))
+    left, top = max(0, left - pad_x), max(0, top - pad_y)
+    right, bottom = min(image_width, right + pad_x), min(image_height, bottom + pad_y)
+
+    # Keep the crop within the shapes the model can generate
+    if right - left > (bottom - top) * max_aspect_ratio:
+        top, bottom = _grow_span(top, bottom, math.ceil((right - left) / max_aspect_ratio), image_height)
+    elif bottom - top > (right - left) * max_aspect_ratio:
+        left, right = _grow_span(left, right, math.ceil((bottom - top) / max_aspect_ratio), image_width)
+
+    # Grow to the next multiple, shifting the box back inside the image at the edges
+    width = min(image_width, -(-(right - left) // multiple) * multiple)
+    height = min(image_height, -(-(bottom - top) // multiple) * multiple)
+    left = min(left, image_width - width)
+    top = min(top, image_height - height)
+    return left, top, left + width, top + height
+
+def inference_size(crop_size, model_pixels=MODEL_PIXELS, multiple=8):
+    """
+    Scale the crop to about the model's native number of pixels, keeping its aspect ratio.
+
+    Returns:
+    - (width, height) of the model input, both multiples of multiple.
+    """
+    width, height = crop_size
+    scale = (model_pixels / (width * height)) ** 0.5
+    return (
+        max(multiple, int(round(width * scale / multiple)) * multiple),
+        max(multiple, int(round(height * scale / multiple)) * multiple),
+    )
+
+def paste_inpainted(original_img, generated_crop, mask, crop_box, feather=DEFAULT_FEATHER):
+    """
+    Blend an inpainted crop back into the original image with a feathered edge.
+
+    The feather only fades inwards from the mask's edge, so every pixel outside the mask stays
+    exactly as it is in the original.
+
+    Parameters:
+    - original_img: PIL.Image object of the original image.
+    - generated_crop: PIL.Image object generated for the crop, at any size.
+    - mask: PIL.Image object of the mask, the size of the original image.
+    - crop_box: (left, top, right, bottom) box the crop was taken from.
+    - feather: Radius of the blend at the mask's edge, in original image pixels.
+
+    Returns:
+    - A new PIL.Image object the size of the original image.
+    """
+    original_crop = original_img.crop(crop_box)
+    generated_crop = generated_crop.resize(original_crop.size, Image.LANCZOS).convert(original_crop.mode)
+    alpha = mask.crop(crop_box).convert("L")
+    if feather:
+        alpha = ImageChops.multiply(alpha.filter(ImageFilter.GaussianBlur(feather)), alpha)
+
+    result = original_img.copy()
+    result.paste(Image.composite(generated_crop, original_crop, alpha), crop_box[:2])
+    return result
+
+# A single image to generate: which concept it belongs to, its index within the concept and its seed.
+# latents is set when refining a draft.
+WorkItem = namedtuple("WorkItem", ["concept", "positive", "negative", "index", "seed", "latents"], defaults=(None,))
+
+# A finished image together with the prompts and seed it was generated from. latents holds the final
+# latents of drafts (on the CPU) so they can be refined later.
+GeneratedImage = namedtuple("GeneratedImage", ["concept", "index", "image", "prompt", "latents"], defaults=(None,))
+
+# How an image is denoised. scheduler is a key of schedulers.SCHEDULERS (None keeps the model's own),
+# scale shrinks the generated resolution and keep_latents returns the final latents with the image.
+GenerationSettings = namedtuple(
+    "GenerationSettings",
+    ["num_inference_steps", "guidance_scale", "strength", "scheduler", "scale", "keep_latents"],
+)
+
+FULL_QUALITY = GenerationSettings(
+    num_inference_steps=20,  # steps between 15 and 30 work well for us
+    guidance_scale=15,
+    strength=0.99,
+    scheduler=None,
+    scale=1.0,
+    keep_latents=False,
+)
+
+# Fast previews: few steps with a fast multistep scheduler, optionally at a lower resolution
+DRAFT = GenerationSettings(
+    num_inference_steps=int(os.getenv("DRAFT_STEPS", "8")),
+    guidance_scale=15,
+    strength=0.99,
+    scheduler=os.getenv("DRAFT_SCHEDULER", "dpm++"),
+    scale=float(os.getenv("DRAFT_SCALE", "1.0")),
+    keep_latents=True,
+)
+
+# Refining starts from a draft's latents, so only part of the schedule is run again
+REFINE = FULL_QUALITY._replace(strength=float(os.getenv("REFINE_STRENGTH", "0.6")))
+
+QUALITY_SETTINGS = {"full": FULL_QUALITY, "draft": DRAFT}
+
+def derive_seed(base_seed, concept, index):
+    """
+    Derive a deterministic per-image seed from the base seed, the concept name and the image index.
+    """
+    digest = hashlib.sha256(f"{base_seed}:{concept}:{index}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big")
+
+def build_work_items(prompt_list, num_output_images, seed=0):
+    """
+    Expand the parsed prompts into one WorkItem per image, ordered by concept and then image index.
+    """
+    return [
+        WorkItem(idea["concept"], idea["positive"], idea["negative"], i, derive_seed(seed, idea["concept"], i))
+        for idea in prompt_list
+        for i in range(num_output_images)
+    ]
+
+def batch_work_items(work_items, max_batch_size):
+    """
+    Split the work items into batches of at most max_batch_size, packing images of different concepts together.
+    """
+    return [work_items[i:i + max_batch_size] for i in range(0, len(work_items), max_batch_size)]
+
+def _prompt_kwargs(pipe, batch):
+    # Imported here so the UI can import this module without loading torch
+    import torch
+
+    # Group consecutive items sharing the same prompts; if every group has the same size, let the
+    # pipeline repeat the prompts with num_images_per_prompt instead of encoding duplicates
+    groups = []
+    for item in batch:
+        if groups and groups[-1][0] == (item.positive, item.negative):
+            groups[-1][1] += 1
+        else:
+            groups.append([(item.positive, item.negative), 1])
+    if len({count for _, count in groups}) == 1:
+        prompts = [prompts for prompts, _ in groups]
+        num_images_per_prompt = groups[0][1]
+    else:
+        prompts = [(item.positive, item.negative) for item in batch]
+        num_images_per_prompt = 1
+
+    if not prompt_embedding_cache.supports(pipe):
+        return {
+            "prompt": [positive for positive, _ in prompts],
+            "negative_prompt": [negative for _, negative in prompts],
+            "num_images_per_prompt": num_images_per_prompt,
+        }
+
+    # Feed cached text encoder outputs instead of strings, so repeated prompts are encoded only once
+    embeddings = [prompt_embedding_cache.get(pipe, positive, negative) for positive, negative in prompts]
+    kwargs = {name: torch.cat([embedding[name] for embedding in embeddings]) for name in EMBEDDING_KWARGS}
+    kwargs["num_images_per_prompt"] = num_images_per_prompt
+    return kwargs
+
+def _decode_latents(pipe, latents):
+    # Same decode the pipeline runs for output_type="pil", including the fp16 VAE upcast
+    import torch
+
+    needs_upcasting = pipe.vae.dtype == torch.float16 and pipe.vae.config.force_upcast
+    if needs_upcasting:
+        pipe.upcast_vae()
+    with torch.no_grad():
+        decoded = pipe.vae.decode(latents.to(pipe.vae.dtype) / pipe.vae.config.scaling_factor, return_dict=False)[0]
+    if needs_upcasting:
+        pipe.vae.to(dtype=torch.float16)
+    return pipe.image_processor.postprocess(decoded, output_type="pil")
+
+def _start_latents(batch, image_latents):
+    # Draft latents to refine from, resized to the site's latent resolution if the draft was smaller.
+    # Drafts coming back from a worker process carry their latents as numpy arrays.
+    import torch
+
+    latents = torch.stack([torch.as_tensor(item.latents) for item in batch]).to(device=image_latents.device, dtype=image_latents.dtype)
+    if latents.shape[-2:] != image_latents.shape[-2:]:
+        latents = torch.nn.functional.interpolate(latents, size=image_latents.shape[-2:], mode="bicubic")
+    return latents
+
+def _site_tensors(site):
+    # A single SiteContext is broadcast by the pipeline; one per item (all of the same size) is
+    # stacked along the batch dimension, so items of different requests can share a call
+    import torch
+
+    if isinstance(site, list) and all(other is site[0] for other in site):
+        site = site[0]
+    if not isinstance(site, list):
+        return site.image_latents, site.mask, site.masked_image_latents, site.size
+    if len({other.size for other in site}) != 1:
+        raise ValueError("Every site of a batch must be prepared at the same size.")
+    return (
+        torch.cat([other.image_latents for other in site]),
+        torch.cat([other.mask for other in site]),
+        torch.cat([other.masked_image_latents for other in site]),
+        site[0].size,
+    )
+
+class _StepTimer:
+    # Diffusers step callback recording every denoising step as a span. It only sees the end of each
+    # step, so the first step also holds the little setup the pipeline does before its loop.
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def __call__(self, pipe, step, timestep, callback_kwargs):
+        now = time.perf_counter()
+        telemetry.record("diffusion.step", now - self.last, step=step)
+        self.last = now
+        return callback_kwargs
+
+def run_batch(pipe, batch, site, settings=FULL_QUALITY):
+    """
+    Generate the images of one batch of work items in a single pipeline call.
+
+    Parameters:
+    - pipe: Loaded inpainting pipeline.
+    - batch: List of WorkItem objects. If they carry latents, generation starts from those instead of the site.
+    - site: SiteContext of the site image and mask, from site_context, or a list with one SiteContext
+      per work item when the batch mixes sites prepared at the same size.
+    - settings: GenerationSettings to denoise with.
+
+    Returns:
+    - A list of (PIL.Image, latents) tuples in the same order as the batch. latents is a CPU tensor
+      when settings.keep_latents is set, otherwise None.
+    """
+    # Imported here so the UI can import this module without loading torch
+    import torch
+
+    # One CPU generator per image keeps every image reproducible from its own seed, whatever
+    # batch it lands in and whatever device runs it
+    generators = [torch.Generator(device="cpu").manual_seed(item.seed) for item in batch]
+    image_latents, mask, masked_image_latents, (width, height) = _site_tensors(site)
+    refining = batch[0].latents is not None
+    with telemetry.span("diffusion.call", images=len(batch), steps=settings.num_inference_steps, width=width, height=height):
+        with telemetry.span("diffusion.prompts"):
+            prompt_kwargs = _prompt_kwargs(pipe, batch)
+        # Only timed when telemetry is on, so the pipeline runs without a callback otherwise
+        step_timer = _StepTimer() if telemetry.ENABLED else None
+        # The site is passed as precomputed latents, so the pipeline skips resizing, normalising
+        # and VAE encoding the image and mask on every call
+        output = with_scheduler(pipe, settings.scheduler)(
+            image=_start_latents(batch, image_latents) if refining else image_latents,
+            mask_image=mask,
+            masked_image_latents=masked_image_latents,
+            width=width,
+            height=height,
+            generator=generators,
+            guidance_scale=settings.guidance_scale,
+            num_inference_steps=settings.num_inference_steps,
+            strength=settings.strength,
+            output_type="latent" if settings.keep_latents else "pil",
+            callback_on_step_end=step_timer,
+            **prompt_kwargs,).images
+        if not settings.keep_latents:
+            if step_timer is not None:
+                # Everything after the last step: decoding the latents and converting them to images
+                telemetry.record("diffusion.decode", time.perf_counter() - step_timer.last)
+            return [(image, None) for image in output]
+        with telemetry.span("diffusion.decode"):
+            images = _decode_latents(pipe, output)
+        return list(zip(images, output.cpu()))
+
+def plan_site(image, mask, crop_to_mask=None, context_padding=None, scale=1.0):
+    """
+    Decide which part of the site the model sees and at what size. Needs no pipeline, so it can run
+    in a different process than the one generating.
+
+    Parameters:
+    - image, mask, crop_to_mask, context_padding: See iter_images_from_prompts.
+    - scale: Fraction of the model's native resolution to generate at.
+
+    Returns:
+    - A (model_image, model_mask, size, finish) tuple: the image and mask to encode, the (width, height)
+      to generate at (None for the model's default) and a function that turns a generated image back
+      into a full-size result.
+    """
+    crop_to_mask = DEFAULT_CROP_TO_MASK if crop_to_mask is None else crop_to_mask
+    context_padding = DEFAULT_CONTEXT_PADDING if context_padding is None else context_padding
+
+    # In crop mode the model only sees the masked region, so latency and memory follow the size
+    # of the selection rather than of the photo
+    bbox = mask.getbbox() if crop_to_mask else None
+    if bbox:
+        crop_box = compute_crop_box(bbox, image.size, context_padding)
+        model_image, model_mask = image.crop(crop_box), mask.crop(crop_box)
+        size = inference_size(model_image.size, model_pixels=MODEL_PIXELS * scale * scale)
+
+        def finish(generated_image):
+            return paste_inpainted(image, generated_image, mask, crop_box)
+    else:
+        model_image, model_mask = image, mask
+        size = None
+        if scale != 1.0:
+            side = int(MODEL_PIXELS ** 0.5 * scale) // 8 * 8
+            size = (side, side)
+
+        def finish(generated_image):
             # Resize the generated image to match the dimensions of the original image
-            generated_image = resize_generated_image_to_original(generated_image, image)
-
-            print(f"Image generation successful for concept: '{concept}' ({i+1}/{num_output_images})")
-            
-            # Save the generated image
-            generated_image.save(concept_path + f"generated_image_{i}.png")
-        
-        # Save the positive and negative prompts as text file in the same folder
-        with open(concept_path + "prompts.txt", "w") as file:
-            file.write(f"Positive prompt: {positive}\nNegative prompt: {negative}")
-        
-    print("Image generation complete.")
+            return resize_generated_image_to_original(generated_image, image)
+
+    return model_image, model_mask, size, finish
+
+def refine_work_items(drafts):
+    """
+    Turn drafts back into work items that start from their latents, keeping each draft's prompts and seed.
+    """
+    return [
+        WorkItem(draft.concept, draft.prompt["positive"], draft.prompt["negative"], draft.index, draft.prompt["seed"], draft.latents)
+        for draft in drafts
+    ]
+
+def to_generated_image(item, image, quality, latents=None):
+    """
+    Return the GeneratedImage of a work item, recording its prompts, seed and quality.
+    """
+    prompt = {"positive": item.positive, "negative": item.negative, "seed": item.seed, "quality": quality}
+    return GeneratedImage(item.concept, item.index, image, prompt, latents)
+
+def _generate(model, work_items, model_image, model_mask, size, settings, max_batch_size):
+    # Yields (image, latents) per work item; the pipeline is only loaded when there is work to do
+    if not work_items:
+        return
+    # Loaded once per process and shared across reruns and sessions
+    pipe = get_pipeline(model)
+    # Preprocessed and VAE encoded once, then shared by every image of the request
+    site = site_context_cache.get(pipe, model_image, model_mask, size)
+
+    # Generate images, several concepts per pipeline call
+    for batch in batch_work_items(work_items, max_batch_size):
+        yield from run_batch(pipe, batch, site, settings)
+
+def _iter_work_items(model, work_items, plan, settings, max_batch_size, quality):
+    model_image, model_mask, size, finish = plan
+
+    # Images generated before from exactly the same inputs are served from disk without touching the device
+    cache = default_image_cache()
+    if cache is not None:
+        lookups = cache.lookup(site_fingerprint(model, model_image, model_mask, size), settings, work_items)
+    else:
+        lookups = [(None, None)] * len(work_items)
+    generated = _generate(
+        model, [item for item, (_, entry) in zip(work_items, lookups) if entry is None], model_image, model_mask, size, settings, max_batch_size
+    )
+
+    for item, (key, entry) in zip(work_items, lookups):
+        if entry is None:
+            entry = next(generated)
+            telemetry.count("images_generated_total", quality=quality)
+            if cache is not None:
+                cache.put(key, *entry)
+        generated_image, latents = entry
+        with telemetry.span("image.finish"):
+            result = to_generated_image(item, finish(generated_image), quality, latents)
+        yield result
+
+def iter_images_from_prompts(prompt_list, image, mask, num_output_images, model, max_batch_size=None, seed=0, crop_to_mask=None, context_padding=None, quality="full"):
+    """
+    Generate the images for every concept and yield each one as soon as its batch finishes.
+
+    Parameters:
+    - prompt_list: List of {"concept", "positive", "negative"} dictionaries.
+    - image: PIL.Image object of the site.
+    - mask: PIL.Image object of the mask.
+    - num_output_images: Number of images per concept.
+    - model: Hugging Face repo ID of the inpainting model.
+    - max_batch_size: Maximum number of images per pipeline call. Defaults to the execution profile's.
+    - seed: Base seed the per-image seeds are derived from.
+    - crop_to_mask: Inpaint only the mask's bounding box plus context at the model's native resolution
+      and blend it back into the untouched original. Defaults to INPAINT_CROP_TO_MASK.
+    - context_padding: Context around the mask in crop mode, as a fraction of the mask's size.
+    - quality: "full", or "draft" for fast previews that can be passed to iter_refined_images.
+
+    Yields:
+    - GeneratedImage tuples of (concept, index, image, prompt, latents), where prompt holds the positive and
+      negative prompts, the seed and the quality, and latents is only set for drafts.
+    """
+    settings = QUALITY_SETTINGS[quality]
+    plan = plan_site(image, mask, crop_to_mask, context_padding, settings.scale)
+    work_items = build_work_items(prompt_list, num_output_images, seed)
+    yield from _iter_work_items(model, work_items, plan, settings, max_batch_size or select_profile().max_batch_size, quality)
+
+def iter_refined_images(drafts, image, mask, model, max_batch_size=None, crop_to_mask=None, context_padding=None):
+    """
+    Render selected drafts at full quality, starting from each draft's latents with the same seed.
+
+    Parameters:
+    - drafts: GeneratedImage tuples produced with quality="draft".
+    - image, mask, crop_to_mask, context_padding: The same as for the drafts.
+    - model, max_batch_size: See iter_images_from_prompts.
+
+    Yields:
+    - GeneratedImage tuples of the refined images, in the order of the drafts.
+    """
+    plan = plan_site(image, mask, crop_to_mask, context_padding)
+    yield from _iter_work_items(model, refine_work_items(drafts), plan, REFINE, max_batch_size or select_profile().max_batch_size, "full")
+
+def generate_image_from_prompts(prompt_list, image, mask, num_output_images, output_path, model, max_batch_size=None, seed=0, sink=None, executor=None):
+    """
+    Generate the images for every concept and hand them to an output sink.
+
+    Parameters:
+    - output_path: Directory to archive the images in when no sink is given.
+    - sink: Output sink from image_sinks. Defaults to an ArchiveSink on output_path.
+    - executor: sharded_executor.ShardedExecutor to spread the images over several devices or
+      processes. Defaults to generating in this process.
+    - See iter_images_from_prompts for the other parameters.
+
+    Returns:
+    - The sink holding the results.
+    """
+    sink = sink or ArchiveSink(output_path)
+    sink.begin(prompt_list)
+    generate = executor.iter_images_from_prompts if executor is not None else iter_images_from_prompts
+    for result in generate(prompt_list, image, mask, num_output_images, model, max_batch_size, seed):
+        sink.add(result)
+    return sink
 
 if __name__ == "__main__":
     # Example usage
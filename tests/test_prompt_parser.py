@@ -0,0 +1,82 @@
+import pytest
+
+from prompt_parser import ConceptParseError, IncrementalConceptParser, parse_concepts, split_concepts
+
+PROMPTS = """Thought: Do I need to use a tool? No
+Final Answer: [
+  {"concept": "Folded Roof", "positive": "a pavilion with a folded timber roof", "negative": "blurry"},
+  {'concept': 'Courtyard', 'positive': 'a courtyard house, {brick}', 'negative': 'distorted'}
+]"""
+
+
+def test_parse_concepts():
+    assert [idea["concept"] for idea in parse_concepts(PROMPTS)] == ["Folded Roof", "Courtyard"]
+    assert parse_concepts(PROMPTS)[1]["positive"] == "a courtyard house, {brick}"
+
+
+def test_incremental_parser_returns_each_concept_as_soon_as_it_closes():
+    parser = IncrementalConceptParser()
+    completed = [[idea["concept"] for idea in parser.feed(PROMPTS[start:start + 7])] for start in range(0, len(PROMPTS), 7)]
+
+    assert [names for names in completed if names] == [["Folded Roof"], ["Courtyard"]]
+    assert len(parser.close()) == 2
+
+
+def test_repeated_answer_is_not_parsed_twice():
+    assert len(parse_concepts(PROMPTS + "\n" + PROMPTS)) == 2
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "No list here",
+        '[{"concept": "Folded Roof", "positive": "a pavilion"}]',
+        '[{"concept": "Folded Roof", "positive": ',
+        '[{concept: broken}]',
+    ],
+)
+def test_unparsable_answers_raise(text):
+    with pytest.raises(ConceptParseError):
+        parse_concepts(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "1. Concept 1: The Folded Roof\nA timber roof.\n2. Concept 2: The Courtyard\nA brick house.",
+        "**Concept 1 - The Folded Roof**\nA timber roof.\n**Concept 2 - The Courtyard**\nA brick house.",
+        "### Concept 1\nA timber roof.\n### Concept 2\nA brick house.",
+        "1. **Concept 1: The Folded Roof**\nA timber roof.\n2. **Concept 2: The Courtyard**\nA brick house.",
+        "**Concept 1**: The Folded Roof\nA timber roof.\n**Concept 2**: The Courtyard\nA brick house.",
+    ],
+)
+def test_split_concepts_at_headings(text):
+    concepts = split_concepts("Here are the concepts:\n" + text, expected=2)
+
+    assert len(concepts) == 2
+    assert "timber" in concepts[0] and "brick" in concepts[1]
+
+
+def test_prose_mentioning_a_concept_is_not_a_heading():
+    text = "**Concept 1: A**\ntext\n**Concept 2: B**\nConcept 3 is not here, it says"
+
+    assert len(split_concepts(text)) == 2
+    assert split_concepts(text)[1].endswith("it says")
+
+
+def test_headings_must_match_the_expected_number_of_concepts():
+    text = "### Concept 1\nA timber roof.\n### Concept 2\nA brick house."
+
+    assert split_concepts(text, expected=3) == []
+
+
+def test_numbered_items_are_split_only_when_there_is_one_per_concept():
+    text = "1. The Folded Roof\n   1. timber\n   2. glass\n2. The Courtyard\n3. The Tower"
+
+    assert [concept.splitlines()[0] for concept in split_concepts(text, expected=3)] == [
+        "1. The Folded Roof",
+        "2. The Courtyard",
+        "3. The Tower",
+    ]
+    assert split_concepts(text, expected=5) == []
+    assert split_concepts(text) == []
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from tools.search_cache import CachedSearch, SearchCache, normalise_query, search_many
+import tools.search_cache as search_cache
+
+
+class FakeBackend:
+  """Local stand-in for Tavily: answers every query with its own text after its delay in seconds,
+  optionally waiting for release to be set first"""
+
+  def __init__(self, delay=0.0, fail=False, delays=None):
+    self.delay = delay
+    self.delays = delays or {}
+    self.fail = fail
+    self.calls = []
+    self.release = threading.Event()
+    self.release.set()
+    self._lock = threading.Lock()
+
+  def search(self, query, max_results):
+    with self._lock:
+      self.calls.append(query)
+    self.release.wait()
+    time.sleep(self.delays.get(query, self.delay))
+    if self.fail:
+      raise RuntimeError("search failed")
+    return [f"result for {query}"]
+
+
+@pytest.fixture
+def cache(tmp_path):
+  return SearchCache(str(tmp_path / "search_cache.sqlite"), ttl_seconds=3600, max_entries=100)
+
+
+def test_normalise_query():
+  assert normalise_query("  What is  a Pavilion?? ") == "what is a pavilion"
+
+
+def test_rephrased_query_is_served_from_the_cache(cache):
+  backend = FakeBackend()
+  search = CachedSearch(backend, cache)
+
+  assert search.search("What is a pavilion?") == ["result for what is a pavilion"]
+  assert search.search("what is a  PAVILION") == ["result for what is a pavilion"]
+  assert backend.calls == ["what is a pavilion"]
+
+
+def test_expired_entries_are_searched_again(tmp_path):
+  backend = FakeBackend()
+  search = CachedSearch(backend, SearchCache(str(tmp_path / "search_cache.sqlite"), ttl_seconds=0, max_entries=100))
+
+  search.search("courtyard")
+  search.search("courtyard")
+  assert len(backend.calls) == 2
+
+
+def test_concurrent_identical_queries_share_one_backend_call(cache):
+  backend = FakeBackend()
+  backend.release.clear()
+  search = CachedSearch(backend, cache)
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(search.search("timber roof"))) for _ in range(5)]
+  for thread in threads:
+    thread.start()
+  # Every caller has missed the cache and is waiting on the leader by now
+  time.sleep(0.2)
+  backend.release.set()
+  for thread in threads:
+    thread.join()
+
+  assert backend.calls == ["timber roof"]
+  assert results == [["result for timber roof"]] * 5
+
+
+def test_followers_see_the_leaders_error(cache):
+  backend = FakeBackend(fail=True)
+  backend.release.clear()
+  search = CachedSearch(backend, cache)
+  errors = []
+
+  def run():
+    try:
+      search.search("facade")
+    except RuntimeError as e:
+      errors.append(str(e))
+
+  threads = [threading.Thread(target=run) for _ in range(3)]
+  for thread in threads:
+    thread.start()
+  time.sleep(0.2)
+  backend.release.set()
+  for thread in threads:
+    thread.join()
+
+  assert backend.calls == ["facade"]
+  assert errors == ["search failed"] * 3
+
+
+def test_leader_checks_the_cache_again(cache):
+  backend = FakeBackend()
+  search = CachedSearch(backend, cache)
+  search.search("atrium")
+  get = cache.get
+  lookups = []
+
+  def get_after_the_first(key):
+    # The first lookup misses as if it ran just before the previous leader stored its results
+    lookups.append(key)
+    return get(key) if len(lookups) > 1 else None
+
+  cache.get = get_after_the_first
+  assert search.search("atrium") == ["result for atrium"]
+  assert backend.calls == ["atrium"]
+
+
+def test_search_many_keeps_query_order_and_times_out_slow_queries(cache, monkeypatch):
+  monkeypatch.setattr(search_cache, "_search", CachedSearch(FakeBackend(delays={"slow": 1.0}), cache))
+
+  outcomes = search_many(["first", "slow", "last"], max_workers=2, timeout=0.3)
+
+  assert [query for query, _, _ in outcomes] == ["first", "slow", "last"]
+  assert outcomes[0] == ("first", ["result for first"], None)
+  assert outcomes[1] == ("slow", [], "timed out after 0.3s")
+  assert outcomes[2] == ("last", ["result for last"], None)
+
+
+def test_search_many_counts_timed_out_searches_against_the_limit(cache, monkeypatch):
+  live = []
+  peak = []
+  lock = threading.Lock()
+
+  class Tracking(FakeBackend):
+    def search(self, query, max_results):
+      with lock:
+        live.append(query)
+        peak.append(len(live))
+      try:
+        return super().search(query, max_results)
+      finally:
+        with lock:
+          live.remove(query)
+
+  monkeypatch.setattr(search_cache, "_search", CachedSearch(Tracking(delay=0.5), cache))
+  outcomes = search_many([f"q{i}" for i in range(4)], max_workers=2, timeout=0.2)
+
+  assert max(peak) == 2
+  assert all(error is not None for _, _, error in outcomes)